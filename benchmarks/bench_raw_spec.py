@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# Description: Specification served from raw bytes stored in Consul compared
+#              with decoding it into objects and encoding the response again,
+#              on List specifications of growing size stored through local
+#              Consul stand-in
+#
+#     python benchmarks/bench_raw_spec.py -o 10 100 1000
+#
+
+import json
+import argparse
+from collections import OrderedDict
+
+import stubs
+from common import load_deployer, free_port, list_spec, measure, peak, report
+
+
+def store(deployer, consul_host, key, payload):
+    """
+    Store specification the way insert route does, revision pointer
+    and content blob with unset ID first (output: str)
+    """
+    blob_key = '{}/{}'.format(
+        deployer.blob_dir(key), deployer.spec_digest(payload)
+    )
+    deployer.create_kv(consul_host, {
+        '{}/latest'.format(key): {'id': '1_bench', 'blob': blob_key},
+        blob_key: OrderedDict(
+            [('id', None)] + [(k, v) for k, v in payload.items() if k != 'id']
+        )
+    })
+
+    return '{}/latest'.format(key)
+
+
+def decoded(deployer, consul_host, key):
+    """
+    Response body as it was built before, specification decoded
+    and envelope encoded by bottle (output: bytes)
+    """
+    payload, _ = deployer.get_spec(consul_host, key)
+
+    return json.dumps({'specifications': payload}).encode('utf-8')
+
+
+def raw(deployer, consul_host, key):
+    """
+    Response body built from stored bytes (output: bytes)
+    """
+    return b''.join(
+        [b'{"specifications":'] +
+        deployer.get_raw_spec(consul_host, key) +
+        [b'}']
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument(
+        '-o', '--objects',
+        help='Number of deployments and services per specification',
+        default=[10, 100, 1000],
+        type=int,
+        nargs='+',
+        dest='objects',
+        action='store'
+    )
+    parser.add_argument(
+        '-r', '--repeat',
+        help='Number of responses per measurement',
+        default=20,
+        type=int,
+        dest='repeat',
+        action='store'
+    )
+    parser.add_argument(
+        '-c', '--compression',
+        help='Storage compression of specifications',
+        default='zlib',
+        choices=['zlib', 'none'],
+        dest='compression',
+        action='store'
+    )
+    args = parser.parse_args()
+
+    deployer = load_deployer()
+    _, consul = stubs.start(free_port(), free_port())
+    consul_host = 'http://127.0.0.1:{}'.format(consul.server_address[1])
+    deployer.STORAGE.update({
+        'prefix': 'kubernetes/specifications/',
+        'blob_prefix': 'kubernetes/blobs/',
+        'chunk_prefix': 'kubernetes/chunks/',
+        'compression': None if args.compression == 'none' else 'zlib'
+    })
+
+    rows = []
+    try:
+        for n in args.objects:
+            payload = list_spec(n)
+            payload['namespace'] = 'bench'
+            key = store(
+                deployer, consul_host,
+                'kubernetes/specifications/bench/svc{}'.format(n), payload
+            )
+
+            body = raw(deployer, consul_host, key)
+            assert json.loads(body) == json.loads(
+                decoded(deployer, consul_host, key)
+            )
+
+            # Cached specification only has to be encoded
+            cached, _ = deployer.get_spec(consul_host, key)
+            rows.append([
+                n,
+                '{:.1f}'.format(len(body) / 1024.0),
+                '{:.2f}'.format(measure(
+                    lambda: decoded(deployer, consul_host, key), args.repeat
+                ) * 1000),
+                '{:.2f}'.format(measure(
+                    lambda: json.dumps({'specifications': cached}),
+                    args.repeat
+                ) * 1000),
+                '{:.2f}'.format(measure(
+                    lambda: raw(deployer, consul_host, key), args.repeat
+                ) * 1000),
+                '{:.2f}'.format(peak(
+                    lambda: decoded(deployer, consul_host, key)
+                )),
+                '{:.2f}'.format(peak(
+                    lambda: raw(deployer, consul_host, key)
+                ))
+            ])
+    finally:
+        consul.shutdown()
+
+    report(rows, [
+        'objects', 'spec (KiB)', 'decoded (ms)', 'cached (ms)', 'raw (ms)',
+        'decoded peak (MiB)', 'raw peak (MiB)'
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Description: Throughput and latency of insert, show, list, deploy and
+#              delete routes driven by concurrent clients against local
+#              Kubernetes and Consul stand-ins with injected latency
+#
+#     pip install gevent
+#     python benchmarks/bench_routes.py -n 500 -c 50 --latency 0.01
+#
+
+import json
+import argparse
+
+import stubs
+from common import free_port, start_deployer, list_spec, drive, percentile
+from common import report
+
+
+def phases(base, count, objects, show_repeat):
+    """
+    Workloads in the order they are run, every one as name, list of
+    items and function that calls the route (output: list)
+    """
+    specs = [
+        json.dumps(list_spec(objects, prefix='svc{}-'.format(i)))
+        for i in range(count)
+    ]
+
+    def insert(session, i):
+        return session.post(
+            '{}/specifications/bench/svc{}'.format(base, i),
+            data=specs[i],
+            headers={'Content-Type': 'application/json'}
+        )
+
+    def show(session, i):
+        return session.get(
+            '{}/specifications/bench/svc{}/latest'.format(base, i % count)
+        )
+
+    def listing(session, i):
+        return session.get(
+            '{}/specifications/bench/svc{}'.format(base, i % count)
+        )
+
+    def deploy(session, i):
+        return session.put('{}/deployments/bench/svc{}'.format(base, i))
+
+    def undeploy(session, i):
+        return session.delete('{}/deployments/bench/svc{}'.format(base, i))
+
+    return [
+        ('insert', range(count), insert),
+        ('show', range(count * show_repeat), show),
+        ('list', range(count * show_repeat), listing),
+        ('deploy', range(count), deploy),
+        ('delete', range(count), undeploy)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument(
+        '-n', '--services',
+        help='Number of services inserted, deployed and deleted',
+        default=500,
+        type=int,
+        dest='services',
+        action='store'
+    )
+    parser.add_argument(
+        '-c', '--concurrency',
+        help='Number of concurrent clients',
+        default=50,
+        type=int,
+        dest='concurrency',
+        action='store'
+    )
+    parser.add_argument(
+        '-o', '--objects',
+        help='Number of deployments and services per specification',
+        default=1,
+        type=int,
+        dest='objects',
+        action='store'
+    )
+    parser.add_argument(
+        '-r', '--show-repeat',
+        help='Number of show and list requests per service',
+        default=4,
+        type=int,
+        dest='show_repeat',
+        action='store'
+    )
+    parser.add_argument(
+        '-s', '--server',
+        help='Web server mode of k8s-deployer',
+        default='gevent',
+        choices=['paste', 'gevent'],
+        dest='server',
+        action='store'
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        help='Number of paste threadpool workers',
+        default=10,
+        type=int,
+        dest='workers',
+        action='store'
+    )
+    parser.add_argument(
+        '--latency',
+        help='Injected latency per backend request in seconds',
+        default=0.01,
+        type=float,
+        dest='latency',
+        action='store'
+    )
+    args = parser.parse_args()
+
+    if args.server == 'gevent':
+        mode_args = ['-s', 'gevent', '-c', str(args.concurrency * 2)]
+    else:
+        mode_args = ['-s', 'paste', '-w', str(args.workers)]
+
+    kube_port, consul_port = free_port(), free_port()
+    kube, consul = stubs.start(kube_port, consul_port, args.latency)
+    proc, port = start_deployer(kube_port, consul_port, mode_args)
+
+    rows = []
+    try:
+        base = 'http://127.0.0.1:{}'.format(port)
+        for name, items, call in phases(base, args.services, args.objects,
+                                        args.show_repeat):
+            elapsed, latencies, errors = drive(call, items, args.concurrency)
+            rows.append([
+                name,
+                len(latencies),
+                '{:.1f}'.format(len(latencies) / elapsed),
+                '{:.1f}'.format(percentile(latencies, 50) * 1000),
+                '{:.1f}'.format(percentile(latencies, 99) * 1000),
+                errors
+            ])
+    finally:
+        proc.terminate()
+        proc.wait()
+        kube.shutdown()
+        consul.shutdown()
+
+    report(rows, [
+        'route', 'requests', 'req/s', 'p50 (ms)', 'p99 (ms)', 'errors'
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# Description: Compare paste threadpool and gevent event loop server modes
+#              under concurrent registration and specification requests
+#              served against local Kubernetes and Consul stand-ins
+#
+#     pip install gevent
+#     python benchmarks/bench_servers.py -n 2000 -c 200 --latency 0.05
+#
+
+import os
+import argparse
+import requests
+
+import stubs
+from common import ROOT, free_port, start_deployer, drive, percentile, report
+
+
+def seed(kube_port, deployer_port, count):
+    """
+    Create NodePort services on Kubernetes stand-in and one specification
+    """
+    session = requests.Session()
+    for i in range(count):
+        session.post(
+            'http://127.0.0.1:{}/api/v1/namespaces/bench/services'.format(
+                kube_port
+            ),
+            json={
+                'kind': 'Service',
+                'apiVersion': 'v1',
+                'metadata': {'name': 'svc{}'.format(i)},
+                'spec': {
+                    'type': 'NodePort',
+                    'ports': [{'port': 80, 'protocol': 'TCP'}]
+                }
+            }
+        )
+
+    with open(os.path.join(ROOT, 'examples', 'echoserver.json')) as f:
+        session.post(
+            'http://127.0.0.1:{}/specifications/bench/echoserver'.format(
+                deployer_port
+            ),
+            data=f.read(),
+            headers={'Content-Type': 'application/json'}
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument(
+        '-n', '--requests',
+        help='Number of requests per server mode',
+        default=2000,
+        type=int,
+        dest='requests',
+        action='store'
+    )
+    parser.add_argument(
+        '-c', '--concurrency',
+        help='Number of concurrent clients',
+        default=200,
+        type=int,
+        dest='concurrency',
+        action='store'
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        help='Number of paste threadpool workers',
+        default=5,
+        type=int,
+        dest='workers',
+        action='store'
+    )
+    parser.add_argument(
+        '--latency',
+        help='Injected latency per backend request in seconds',
+        default=0.05,
+        type=float,
+        dest='latency',
+        action='store'
+    )
+    args = parser.parse_args()
+
+    modes = [
+        ('paste', ['-s', 'paste', '-w', str(args.workers)]),
+        ('gevent', ['-s', 'gevent', '-c', str(args.concurrency * 2)])
+    ]
+
+    rows = []
+    for mode, mode_args in modes:
+        kube_port, consul_port = free_port(), free_port()
+        kube, consul = stubs.start(kube_port, consul_port, args.latency)
+        proc, port = start_deployer(kube_port, consul_port, mode_args, {
+            'consul': {'cache': {'size': 0}}
+        })
+
+        try:
+            seed(kube_port, port, 100)
+            base = 'http://127.0.0.1:{}'.format(port)
+
+            def call(session, i):
+                if i % 2:
+                    return session.put('{}/registration/bench/svc{}'.format(
+                        base, i % 100
+                    ))
+                return session.get(
+                    '{}/specifications/bench/echoserver/latest'.format(base)
+                )
+
+            elapsed, latencies, errors = drive(
+                call, range(args.requests), args.concurrency
+            )
+        finally:
+            proc.terminate()
+            proc.wait()
+            kube.shutdown()
+            consul.shutdown()
+
+        rows.append([
+            mode,
+            '{:.1f}'.format(args.requests / elapsed),
+            '{:.1f}'.format(percentile(latencies, 50) * 1000),
+            '{:.1f}'.format(percentile(latencies, 99) * 1000),
+            errors
+        ])
+
+    report(rows, ['server', 'req/s', 'p50 (ms)', 'p99 (ms)', 'errors'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# Description: Compare streaming consul-template plugin k8s-svcgen.py, with
+#              and without warm content-hash cache, with the previous double
+#              json.loads of the whole tree, on synthetic deployments trees
+#
+#     python benchmarks/bench_svcgen.py -n 1000 10000 50000
+#
+
+import io
+import os
+import json
+import tempfile
+import argparse
+
+from common import load_script, measure, peak, report
+
+# Linux limit of a single argument (MAX_ARG_STRLEN)
+MAX_ARG_STRLEN = 131072
+
+
+def tree(count, namespaces=20):
+    """
+    Exploded deployments tree as rendered by consul-template (output: str)
+    """
+    t = {}
+    for i in range(count):
+        ns = 'ns{}'.format(i % namespaces)
+        name = 'svc{}'.format(i)
+        svc = {
+            'kind': 'Service',
+            'apiVersion': 'v1',
+            'metadata': {
+                'name': name,
+                'namespace': ns,
+                'annotations': {
+                    'traefik.enable': 'true',
+                    'traefik.frontend.rule': 'Host:{}.example.com'.format(name),
+                    'tags': 'kubernetes,k8s'
+                }
+            },
+            'spec': {
+                'type': 'NodePort' if i % 10 else 'ClusterIP',
+                'selector': {'app': name},
+                'ports': [{'port': 80, 'protocol': 'TCP', 'nodePort': 30000 + i}]
+            }
+        }
+        t.setdefault(ns, {})[name] = json.dumps(svc, indent=4)
+
+    return json.dumps(t)
+
+
+def legacy(svcgen, path):
+    """
+    Generation as it was done before, whole tree read and parsed, then
+    every service value parsed once again (output: dict)
+    """
+    with io.open(path, encoding='utf-8') as f:
+        data = f.read()
+
+    svcs = []
+    for ns in json.loads(data).values():
+        for s in ns.values():
+            svc = json.loads(s)
+            if svc['spec']['type'] == 'NodePort':
+                svcs.append(svcgen.svc_def(svc))
+
+    return json.dumps({'services': svcs}, indent=4, separators=(',', ': '))
+
+
+def streaming(svcgen, path):
+    """
+    Generation through incremental tree reader (output: str)
+    """
+    with io.open(path, encoding='utf-8') as f:
+        return svcgen.generate(svcgen.TreeReader(f), svcgen.SvcCache())
+
+
+def cached(svcgen, path, cache):
+    """
+    Generation with warm content-hash cache, services are not parsed
+    at all (output: str)
+    """
+    with io.open(path, encoding='utf-8') as f:
+        output = svcgen.generate(svcgen.TreeReader(f), cache)
+    assert cache.hits == len(cache.seen)
+    cache.hits = 0
+
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument(
+        '-n', '--services',
+        help='Number of services in generated trees',
+        default=[1000, 10000, 50000],
+        type=int,
+        nargs='+',
+        dest='services',
+        action='store'
+    )
+    parser.add_argument(
+        '-r', '--repeat',
+        help='Number of generations per measurement',
+        default=3,
+        type=int,
+        dest='repeat',
+        action='store'
+    )
+    args = parser.parse_args()
+
+    svcgen = load_script('k8s_svcgen', 'consul-template/k8s-svcgen.py')
+
+    rows = []
+    for n in args.services:
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            f.write(tree(n))
+        size = os.path.getsize(path)
+
+        try:
+            cache = svcgen.SvcCache()
+            with io.open(path, encoding='utf-8') as f:
+                svcgen.generate(svcgen.TreeReader(f), cache)
+            cache.entries, cache.seen = cache.seen, {}
+
+            assert cached(svcgen, path, cache) == streaming(svcgen, path)
+
+            old = measure(lambda: legacy(svcgen, path), args.repeat)
+            new = measure(lambda: streaming(svcgen, path), args.repeat)
+            warm = measure(lambda: cached(svcgen, path, cache), args.repeat)
+            rows.append([
+                n,
+                '{:.1f}'.format(size / 2.0**20),
+                'yes' if size < MAX_ARG_STRLEN else 'no',
+                '{:.1f}'.format(old * 1000),
+                '{:.1f}'.format(new * 1000),
+                '{:.1f}'.format(warm * 1000),
+                '{:.1f}'.format(peak(lambda: legacy(svcgen, path))),
+                '{:.1f}'.format(peak(lambda: streaming(svcgen, path)))
+            ])
+        finally:
+            os.remove(path)
+
+    report(rows, [
+        'services', 'tree (MiB)', 'fits argv', 'legacy (ms)',
+        'streaming (ms)', 'cached (ms)', 'legacy peak (MiB)', 'streaming peak (MiB)'
+    ])
+
+
+if __name__ == '__main__':
+    main()
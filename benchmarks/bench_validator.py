@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# Description: Compare precompiled spec_validator() with the per-request
+#              validictory schema it replaced, on large List specifications
+#
+#     pip install validictory
+#     python benchmarks/bench_validator.py -n 10 100 1000
+#
+
+import argparse
+
+from common import load_deployer, list_spec, measure, report
+
+try:
+    import validictory
+except ImportError:
+    validictory = None
+
+
+def legacy_validator(data):
+    """
+    Validation as it was done before (schema built on every call)
+    """
+    schema = {
+        'type': 'object',
+        'properties': {
+            'id': {
+                'type': ['null', 'string']
+            },
+            'namespace': {
+                'type': ['null', 'string']
+            },
+            'objects': {
+                'type': 'object',
+                'properties': {
+                    'deployments': {
+                        'type': 'object',
+                        'properties': {
+                            'specification': {
+                                'type': 'object',
+                                'properties': {
+                                    'kind': {
+                                        'type': ['string']
+                                    }
+                                }
+                            }
+                        }
+                    },
+                    'services': {
+                        'type': 'object',
+                        'properties': {
+                            'specification': {
+                                'type': 'object',
+                                'properties': {
+                                    'kind': {
+                                        'type': ['string']
+                                    }
+                                }
+                            }
+                        }
+                    }
+                },
+                "additionalProperties": False
+            }
+        },
+        "additionalProperties": False
+    }
+
+    validictory.validate(data, schema)
+
+
+def object_schema(deployment=False):
+    """
+    validictory schema of a Kubernetes object with the same coverage as
+    the one compiled by k8s-deployer (output: dict)
+    """
+    schema = {
+        'type': 'object',
+        'properties': {
+            'kind': {'type': 'string', 'required': False},
+            'metadata': {
+                'type': 'object',
+                'properties': {'name': {'type': 'string'}}
+            }
+        }
+    }
+    if deployment:
+        schema['properties']['spec'] = {
+            'type': 'object',
+            'properties': {
+                'selector': {
+                    'type': 'object',
+                    'properties': {'matchLabels': {'type': 'object'}}
+                }
+            }
+        }
+
+    return {
+        'type': [
+            {
+                'type': 'object',
+                'properties': {
+                    'kind': {'type': 'string', 'enum': ['List']},
+                    'items': {'type': 'array', 'items': schema}
+                }
+            },
+            schema
+        ]
+    }
+
+
+def equivalent_validator(data):
+    """
+    validictory validation covering the same fields as spec_validator()
+    """
+    schema = {
+        'type': 'object',
+        'properties': {
+            'id': {'type': ['null', 'string']},
+            'namespace': {'type': ['null', 'string']},
+            'objects': {
+                'type': 'object',
+                'properties': {
+                    'deployments': {
+                        'type': 'object',
+                        'properties': {'specification': object_schema(True)}
+                    },
+                    'services': {
+                        'type': 'object',
+                        'properties': {'specification': object_schema()}
+                    }
+                },
+                'additionalProperties': False
+            }
+        },
+        'additionalProperties': False
+    }
+
+    validictory.validate(data, schema)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument(
+        '-n', '--items',
+        help='Number of deployments and services in List specifications',
+        default=[10, 100, 1000],
+        type=int,
+        nargs='+',
+        dest='items',
+        action='store'
+    )
+    parser.add_argument(
+        '-r', '--repeat',
+        help='Number of validations per measurement',
+        default=200,
+        type=int,
+        dest='repeat',
+        action='store'
+    )
+    args = parser.parse_args()
+
+    deployer = load_deployer()
+
+    rows = []
+    for n in args.items:
+        spec = list_spec(n)
+        compiled = measure(lambda: deployer.spec_validator(spec), args.repeat)
+
+        if validictory is not None:
+            legacy = measure(lambda: legacy_validator(spec), args.repeat)
+            equivalent = measure(
+                lambda: equivalent_validator(spec), args.repeat
+            )
+            speedup = '{:.1f}x'.format(equivalent / compiled)
+            legacy = '{:.1f}'.format(legacy * 10**6)
+            equivalent = '{:.1f}'.format(equivalent * 10**6)
+        else:
+            legacy = equivalent = speedup = 'n/a'
+
+        rows.append([
+            n, legacy, equivalent, '{:.1f}'.format(compiled * 10**6), speedup
+        ])
+
+    # Legacy schema checks only top level fields, equivalent one also
+    # descends into every object of List specifications like compiled one
+    report(rows, [
+        'items', 'legacy (us)', 'equivalent (us)', 'compiled (us)', 'speedup'
+    ])
+    if validictory is None:
+        print('\nvalidictory is not installed, legacy path was skipped')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+# Description: Helpers shared by k8s-deployer benchmarks
+
+import os
+import sys
+import copy
+import json
+import time
+import socket
+import tempfile
+import threading
+import subprocess
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_script(name, path):
+    """
+    Import script which isn't a valid module name (output: module)
+    """
+    path = os.path.join(ROOT, path)
+
+    try:
+        from importlib.util import spec_from_file_location, module_from_spec
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+
+    spec = spec_from_file_location(name, path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def load_deployer():
+    """
+    Import k8s-deployer.py as a module (output: module)
+    """
+    return load_script('k8s_deployer', 'k8s-deployer.py')
+
+
+def list_spec(count, prefix='svc'):
+    """
+    Generate k8s-deployer specification with deployments and services
+    of kind List built from examples/echoserver.json (output: dict)
+    """
+    with open(os.path.join(ROOT, 'examples', 'echoserver.json')) as f:
+        base = json.load(f)
+
+    deployment = base['objects']['deployments']['specification']
+    service = base['objects']['services']['specification']
+
+    deployments, services = [], []
+    for i in range(count):
+        name = '{}{}'.format(prefix, i)
+
+        d = copy.deepcopy(deployment)
+        d['metadata']['name'] = name
+        d['metadata']['labels'] = {'app': name}
+        d['spec']['selector']['matchLabels'] = {'app': name}
+        d['spec']['template']['metadata']['labels'] = {'app': name}
+        deployments.append(d)
+
+        s = copy.deepcopy(service)
+        s['metadata']['name'] = name
+        s['spec']['selector'] = {'app': name}
+        services.append(s)
+
+    base['objects']['deployments']['specification'] = {
+        'kind': 'List', 'apiVersion': 'v1', 'items': deployments
+    }
+    base['objects']['services']['specification'] = {
+        'kind': 'List', 'apiVersion': 'v1', 'items': services
+    }
+
+    return base
+
+
+def measure(func, repeat):
+    """
+    Run function repeatedly and return seconds per call (output: float)
+    """
+    start = time.time()
+    for _ in range(repeat):
+        func()
+
+    return (time.time() - start) / repeat
+
+
+def peak(func):
+    """
+    Peak memory allocated during the call in MiB, python 3 only
+    (output: float)
+    """
+    import tracemalloc
+
+    tracemalloc.start()
+    func()
+    _, size = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return size / 2.0**20
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of the list of values (output: float)
+    """
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))
+
+    return values[k]
+
+
+def report(rows, header):
+    """
+    Print table with left aligned first column
+    """
+    widths = [
+        max(len(str(r[i])) for r in [header] + rows)
+        for i in range(len(header))
+    ]
+    for row in [header] + rows:
+        sys.stdout.write('  '.join(
+            str(v).ljust(w) if i == 0 else str(v).rjust(w)
+            for i, (v, w) in enumerate(zip(row, widths))
+        ) + '\n')
+
+
+def free_port():
+    """
+    Find unused local TCP port (output: int)
+    """
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    return port
+
+
+def wait_port(port, timeout=10):
+    """
+    Wait until something listens on the local port
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.2).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+
+    raise RuntimeError('Nothing is listening on port {}'.format(port))
+
+
+def start_deployer(kube_port, consul_port, args=(), config=None):
+    """
+    Start k8s-deployer against local stand-ins in a subprocess
+    (output: tuple of process and port)
+    """
+    conf = {
+        'kubernetes': {
+            'scheme': 'http', 'host': '127.0.0.1', 'port': kube_port,
+            'api': {'headers': {}}
+        },
+        'consul': {
+            'scheme': 'http', 'host': '127.0.0.1', 'port': consul_port,
+            'key_path': 'kubernetes',
+            'specifications': {'retention': 5}
+        }
+    }
+    for backend, values in (config or {}).items():
+        conf.setdefault(backend, {}).update(values)
+
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(conf, f)
+
+    port = free_port()
+    proc = subprocess.Popen(
+        [
+            sys.executable, os.path.join(ROOT, 'k8s-deployer.py'),
+            '-C', path, '-p', str(port)
+        ] + list(args),
+        stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT
+    )
+    wait_port(port)
+
+    return proc, port
+
+
+def drive(func, items, concurrency):
+    """
+    Call function for every item from a pool of concurrent clients,
+    every client keeps its own keep-alive session
+    (output: tuple of wall clock seconds, latencies and error count)
+    """
+    local = threading.local()
+    errors = [0]
+
+    def call(item):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        start = time.time()
+        try:
+            r = func(local.session, item)
+            if r.status_code >= 400:
+                errors[0] += 1
+        except requests.exceptions.RequestException:
+            errors[0] += 1
+
+        return time.time() - start
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(call, items))
+
+    return time.time() - start, latencies, errors[0]
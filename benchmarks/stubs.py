@@ -0,0 +1,654 @@
+#!/usr/bin/env python
+# Description: Lightweight in-memory Kubernetes and Consul API stand-ins
+#
+# Only endpoints used by k8s-deployer are implemented, every response can
+# be delayed by configurable latency to mimic remote backends:
+#
+#     python benchmarks/stubs.py --kube-port 18080 --consul-port 18500 --latency 0.005
+#
+
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+from base64 import b64encode, b64decode
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=None, headers={}, raw=False):
+        if body is None:
+            data = b''
+        elif raw:
+            data = body
+        else:
+            data = json.dumps(body).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def body(self):
+        return self.request_body
+
+    def dispatch(self, method):
+        # Whole body is always consumed to keep connection reusable
+        length = int(self.headers.get('Content-Length') or 0)
+        self.request_body = self.rfile.read(length) if length else b''
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        url = urlparse(self.path)
+        query = dict((k, v[-1]) for k, v in parse_qs(
+            url.query, keep_blank_values=True).items())
+        self.handle_request(method, url.path, query)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PATCH(self):
+        self.dispatch('PATCH')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+
+class ConsulState(object):
+    """
+    Consul K/V store with modify indexes and blocking queries
+    """
+    def __init__(self):
+        self.kv = {}
+        self.index = 1
+        self.cond = threading.Condition()
+        self.services = {}
+
+    def set(self, key, value):
+        with self.cond:
+            self.index += 1
+            self.kv[key] = (value, self.index)
+            self.cond.notify_all()
+
+    def delete(self, key, recurse=False):
+        with self.cond:
+            keys = [
+                k for k in self.kv
+                if k == key or (recurse and k.startswith(key))
+            ]
+            for k in keys:
+                del self.kv[k]
+            self.index += 1
+            self.cond.notify_all()
+
+    def wait(self, index, timeout):
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.index <= index and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+
+
+class ConsulHandler(StubHandler):
+    state = None
+
+    def entry(self, key, value, index):
+        return {
+            'Key': key,
+            'Value': b64encode(value).decode('ascii') if value else None,
+            'Flags': 0,
+            'CreateIndex': index,
+            'ModifyIndex': index,
+            'LockIndex': 0
+        }
+
+    def handle_request(self, method, path, query):
+        state = self.state
+
+        if path == '/v1/txn' and method == 'PUT':
+            return self.txn(json.loads(self.body().decode('utf-8')))
+
+        if path.startswith('/v1/agent/service/register'):
+            svc = json.loads(self.body().decode('utf-8'))
+            svc_id = svc.get('ID') or svc['Name']
+            state.services[svc_id] = {
+                'ID': svc_id,
+                'Service': svc['Name'],
+                'Tags': svc.get('Tags') or [],
+                'Meta': svc.get('Meta') or {},
+                'Port': svc.get('Port', 0),
+                'Address': svc.get('Address', '')
+            }
+            return self.reply(200)
+
+        if path.startswith('/v1/agent/service/deregister/'):
+            state.services.pop(path.rsplit('/', 1)[1], None)
+            return self.reply(200)
+
+        if path == '/v1/agent/services':
+            return self.reply(200, state.services)
+
+        if not path.startswith('/v1/kv/'):
+            return self.reply(404)
+
+        key = path[len('/v1/kv/'):]
+
+        if method == 'PUT':
+            state.set(key, self.body())
+            return self.reply(200, True)
+
+        if method == 'DELETE':
+            state.delete(key, recurse='recurse' in query)
+            return self.reply(200, True)
+
+        if 'index' in query:
+            wait = query.get('wait', '5m')
+            seconds = float(wait[:-1]) * (60 if wait.endswith('m') else 1)
+            state.wait(int(query['index']), seconds)
+
+        headers = {'X-Consul-Index': str(state.index)}
+        prefix = key.rstrip('/') if key.endswith('/') else key
+
+        if 'keys' in query or 'recurse' in query:
+            keys = sorted(k for k in state.kv if k.startswith(key))
+            if 'separator' in query and 'keys' in query:
+                sep = query['separator']
+                shallow = []
+                for k in keys:
+                    rest = k[len(key):]
+                    if sep in rest:
+                        k = key + rest[:rest.index(sep) + 1]
+                    if not shallow or shallow[-1] != k:
+                        shallow.append(k)
+                keys = shallow
+            if not keys:
+                return self.reply(404, headers=headers)
+            if 'keys' in query:
+                return self.reply(200, keys, headers)
+            # Keys could be deleted concurrently in the meantime
+            entries = [(k, state.kv.get(k)) for k in keys]
+            return self.reply(200, [
+                self.entry(k, e[0], e[1]) for k, e in entries if e is not None
+            ], headers)
+
+        entry = state.kv.get(prefix)
+        if entry is None:
+            return self.reply(404, headers=headers)
+
+        value, index = entry
+        headers['X-Consul-Index'] = str(index)
+        if 'raw' in query:
+            return self.reply(200, value, headers, raw=True)
+
+        return self.reply(200, [self.entry(prefix, value, index)], headers)
+
+    def txn(self, ops):
+        state = self.state
+        results = []
+        with state.cond:
+            # Checks fail the whole transaction before anything is applied
+            errors = []
+            for i, op in enumerate(ops):
+                kv = op['KV']
+                index = state.kv.get(kv['Key'], (None, 0))[1]
+                if (kv['Verb'] == 'check-not-exists' and index or
+                        kv['Verb'] == 'check-index' and index != kv['Index'] or
+                        kv['Verb'] == 'get' and not index):
+                    errors.append({'OpIndex': i, 'What': 'check failed'})
+            for op in ops if not errors else []:
+                kv = op['KV']
+                if kv['Verb'] == 'set':
+                    state.set(kv['Key'], b64decode(kv.get('Value') or ''))
+                    results.append(
+                        {'KV': self.entry(kv['Key'], None, state.index)}
+                    )
+                elif kv['Verb'] == 'delete':
+                    state.delete(kv['Key'])
+                elif kv['Verb'] == 'delete-tree':
+                    state.delete(kv['Key'], recurse=True)
+                elif kv['Verb'] == 'get':
+                    value, index = state.kv.get(kv['Key'], (None, 0))
+                    results.append({'KV': self.entry(kv['Key'], value, index)})
+
+        if errors:
+            return self.reply(409, {'Results': None, 'Errors': errors})
+
+        return self.reply(200, {'Results': results, 'Errors': None})
+
+
+class KubeState(object):
+    """
+    Kubernetes objects grouped by resource and namespace
+    """
+    def __init__(self, history=10000, rollout=0.0):
+        self.objects = {}
+        # Seconds until deployment becomes available after create/update
+        self.rollout = rollout
+        self.version = 1
+        self.lock = threading.Condition()
+        self.node_port = 30000
+        # Watch events, oldest are compacted like etcd does
+        self.events = []
+        self.history = history
+        self.compacted = 0
+        # Number of API discovery requests served
+        self.discoveries = 0
+
+    def bump(self):
+        self.version += 1
+        return str(self.version)
+
+    def roll_out(self, ns, name, generation):
+        """
+        Mark deployment generation as fully rolled out
+        """
+        with self.lock:
+            obj = self.objects.get('deployments', {}).get((ns, name))
+            if obj is None or obj['metadata']['generation'] != generation:
+                return
+            replicas = obj['status']['replicas']
+            obj['status'].update({
+                'updatedReplicas': replicas,
+                'readyReplicas': replicas,
+                'availableReplicas': replicas
+            })
+            obj['metadata']['resourceVersion'] = self.bump()
+            self.record('deployments', 'MODIFIED', obj)
+
+    def record(self, res, event_type, obj):
+        """
+        Append watch event, caller has to hold the lock
+        """
+        obj = json.loads(json.dumps(obj))
+        # Deletion gets its own resourceVersion like on real API server
+        if event_type == 'DELETED' or not obj['metadata'].get('resourceVersion'):
+            obj['metadata']['resourceVersion'] = self.bump()
+        self.events.append((
+            int(obj['metadata']['resourceVersion']), res,
+            obj['metadata'].get('namespace'), event_type, obj
+        ))
+        if len(self.events) > self.history:
+            self.compacted = self.events.pop(0)[0]
+        self.lock.notify_all()
+
+
+class KubeHandler(StubHandler):
+    state = None
+    path_re = re.compile(
+        r'^/(?:api/v1|apis/[^/]+/[^/]+)'
+        r'(?:/namespaces/(?P<ns>[^/]+))?/(?P<res>[a-z]+)/?(?P<name>[^/]*)$'
+    )
+
+    def handle_request(self, method, path, query):
+        state = self.state
+
+        if path.rstrip('/') in self.discovery_paths:
+            return self.discovery(path.rstrip('/'))
+
+        m = self.path_re.match(path)
+        if m is None:
+            return self.reply(404, {'kind': 'Status', 'code': 404})
+
+        ns, res, name = m.group('ns'), m.group('res'), m.group('name')
+
+        if method == 'GET' and not name and query.get('watch') in ['1', 'true']:
+            return self.watch(res, ns, query)
+
+        with state.lock:
+            objs = state.objects.setdefault(res, {})
+
+            if method == 'POST':
+                obj = json.loads(self.body().decode('utf-8'))
+                obj_name = obj['metadata']['name']
+                if (ns, obj_name) in objs:
+                    return self.reply(409, {'kind': 'Status', 'code': 409})
+                self.prepare(res, obj, ns)
+                objs[(ns, obj_name)] = obj
+                state.record(res, 'ADDED', obj)
+                if res == 'deployments':
+                    self.replicaset(obj, ns)
+                return self.reply(201, obj)
+
+            if method == 'DELETE' and not name:
+                selector = self.selector(query.get('labelSelector'))
+                for key in [k for k, o in objs.items()
+                            if k[0] == ns and selector(o)]:
+                    state.record(res, 'DELETED', objs.pop(key))
+                return self.reply(200, {'kind': 'Status', 'code': 200})
+
+            if not name:
+                selector = self.selector(query.get('labelSelector'))
+                items = [
+                    o for k, o in sorted(objs.items())
+                    if (ns is None or k[0] == ns) and selector(o)
+                ]
+                return self.reply(200, {
+                    'kind': 'List',
+                    'metadata': {'resourceVersion': str(state.version)},
+                    'items': items
+                })
+
+            obj = objs.get((ns, name))
+            if obj is None:
+                return self.reply(404, {'kind': 'Status', 'code': 404})
+
+            if method == 'GET':
+                return self.reply(200, obj)
+
+            if method == 'PATCH':
+                patch = json.loads(self.body().decode('utf-8'))
+                self.merge(obj, patch)
+                self.prepare(res, obj, ns)
+                state.record(res, 'MODIFIED', obj)
+                return self.reply(200, obj)
+
+            if method == 'DELETE':
+                del objs[(ns, name)]
+                state.record(res, 'DELETED', obj)
+                # Delete options are accepted as body or query parameters
+                options = json.loads(self.body().decode('utf-8') or '{}')
+                options.update(query)
+                if options.get('propagationPolicy') in ['Foreground',
+                                                        'Background']:
+                    rss = state.objects.setdefault('replicasets', {})
+                    for key in [k for k, o in rss.items() if k[0] == ns and
+                                o['metadata'].get('ownerName') == name]:
+                        state.record('replicasets', 'DELETED', rss.pop(key))
+                return self.reply(200, obj)
+
+        return self.reply(405)
+
+    def watch(self, res, ns, query):
+        """
+        Stream watch events newer than requested resourceVersion
+        """
+        since = int(query.get('resourceVersion') or 0)
+        deadline = time.time() + float(query.get('timeoutSeconds') or 300)
+        bookmarks = query.get('allowWatchBookmarks') == 'true'
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def send(event_type, obj):
+            data = json.dumps(
+                {'type': event_type, 'object': obj}
+            ).encode('utf-8') + b'\n'
+            self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii'))
+            self.wfile.write(data + b'\r\n')
+            self.wfile.flush()
+
+        try:
+            self.stream(send, res, ns, since, deadline, bookmarks)
+            self.wfile.write(b'0\r\n\r\n')
+        except (IOError, OSError):
+            self.close_connection = True
+
+    def stream(self, send, res, ns, since, deadline, bookmarks):
+        state = self.state
+
+        with state.lock:
+            if since and since < state.compacted:
+                return send('ERROR', {
+                    'kind': 'Status', 'code': 410, 'reason': 'Expired'
+                })
+            if not since:
+                for (obj_ns, _), obj in sorted(
+                        state.objects.get(res, {}).items()):
+                    if ns is None or obj_ns == ns:
+                        send('ADDED', obj)
+                since = state.version
+
+        while time.time() < deadline:
+            with state.lock:
+                events = [
+                    e for e in state.events
+                    if e[0] > since and e[1] == res and
+                    (ns is None or e[2] == ns)
+                ]
+                # No matching events up to current version, safe to skip
+                version = state.version
+                if not events and version == since:
+                    state.lock.wait(max(0, min(1.0, deadline - time.time())))
+                    continue
+            for version, _, _, event_type, obj in events:
+                send(event_type, obj)
+                since = version
+            if not events:
+                since = version
+                if bookmarks:
+                    send('BOOKMARK', {
+                        'kind': 'Bookmark',
+                        'metadata': {'resourceVersion': str(version)}
+                    })
+
+    def prepare(self, res, obj, ns):
+        state = self.state
+        meta = obj.setdefault('metadata', {})
+        meta['namespace'] = ns
+        meta['resourceVersion'] = state.bump()
+        meta['generation'] = meta.get('generation', 0) + 1
+
+        if res == 'services':
+            spec = obj.setdefault('spec', {})
+            spec.setdefault('type', 'ClusterIP')
+            for port in spec.get('ports', []):
+                if spec['type'] == 'NodePort' and 'nodePort' not in port:
+                    state.node_port += 1
+                    port['nodePort'] = state.node_port
+        elif res == 'deployments':
+            replicas = obj.get('spec', {}).get('replicas', 1)
+            ready = replicas if not state.rollout else 0
+            obj['status'] = {
+                'observedGeneration': meta['generation'],
+                'replicas': replicas,
+                'updatedReplicas': ready,
+                'readyReplicas': ready,
+                'availableReplicas': ready
+            }
+            if state.rollout:
+                timer = threading.Timer(state.rollout, state.roll_out, (
+                    ns, meta['name'], meta['generation']
+                ))
+                timer.daemon = True
+                timer.start()
+
+    def replicaset(self, deployment, ns):
+        name = '{}-{}'.format(
+            deployment['metadata']['name'], self.state.version)
+        labels = deployment.get('spec', {}).get(
+            'selector', {}).get('matchLabels', {})
+        rs = {
+            'kind': 'ReplicaSet',
+            'metadata': {
+                'name': name,
+                'namespace': ns,
+                'labels': dict(labels),
+                'ownerName': deployment['metadata']['name']
+            }
+        }
+        self.state.objects.setdefault('replicasets', {})[(ns, name)] = rs
+
+    def merge(self, target, patch):
+        for k, v in patch.items():
+            if v is None:
+                target.pop(k, None)
+            elif isinstance(v, dict) and isinstance(target.get(k), dict):
+                self.merge(target[k], v)
+            else:
+                target[k] = v
+
+    def selector(self, label_selector):
+        if not label_selector:
+            return lambda obj: True
+
+        pairs = [s.split('=', 1) for s in label_selector.split(',')]
+
+        def match(obj):
+            labels = obj.get('metadata', {}).get('labels', {})
+            return all(labels.get(k) == v for k, v in pairs)
+
+        return match
+
+    # Served group versions and their resources, same as on a cluster
+    # which still serves deprecated extensions group
+    resources = {
+        'v1': ['services', 'services/status', 'pods', 'namespaces'],
+        'apps/v1': ['deployments', 'deployments/scale', 'replicasets'],
+        'apps/v1beta1': ['deployments', 'deployments/scale'],
+        'extensions/v1beta1': ['deployments', 'replicasets', 'ingresses']
+    }
+    groups = [
+        ('extensions', ['v1beta1']),
+        ('apps', ['v1', 'v1beta1']),
+        ('metrics.k8s.io', ['v1beta1'])
+    ]
+    # Aggregated APIs whose backing server is down
+    unavailable = ['metrics.k8s.io/v1beta1']
+    discovery_paths = ['/api', '/apis'] + [
+        '/api/v1' if gv == 'v1' else '/apis/' + gv
+        for gv in list(resources) + unavailable
+    ]
+
+    def discovery(self, path):
+        self.state.discoveries += 1
+        if path == '/api':
+            return self.reply(200, {'kind': 'APIVersions', 'versions': ['v1']})
+        if path == '/apis':
+            return self.reply(200, {'kind': 'APIGroupList', 'groups': [
+                {
+                    'name': name,
+                    'versions': [
+                        {'groupVersion': '{}/{}'.format(name, v), 'version': v}
+                        for v in versions
+                    ],
+                    'preferredVersion': {
+                        'groupVersion': '{}/{}'.format(name, versions[0]),
+                        'version': versions[0]
+                    }
+                }
+                for name, versions in self.groups
+            ]})
+
+        gv = path[len('/api/'):] if path == '/api/v1' else path[len('/apis/'):]
+        if gv in self.unavailable:
+            return self.reply(503, {
+                'kind': 'Status', 'code': 503, 'reason': 'ServiceUnavailable'
+            })
+        return self.reply(200, {
+            'kind': 'APIResourceList',
+            'groupVersion': gv,
+            'resources': [
+                {'name': res, 'namespaced': res != 'namespaces'}
+                for res in self.resources[gv]
+            ]
+        })
+
+
+def serve(handler, port):
+    server = ThreadingServer(('127.0.0.1', port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+def start(kube_port, consul_port, latency=0.0, rollout=0.0):
+    """
+    Start Kubernetes and Consul stand-ins in background threads
+    (output: tuple)
+    """
+    kube = type('Kube', (KubeHandler,), {
+        'state': KubeState(rollout=rollout), 'latency': latency
+    })
+    consul = type('Consul', (ConsulHandler,), {
+        'state': ConsulState(), 'latency': latency
+    })
+
+    return serve(kube, kube_port), serve(consul, consul_port)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter
+            )
+    parser.add_argument(
+        '--kube-port',
+        help='Kubernetes API stand-in port',
+        default=18080,
+        type=int,
+        dest='kube_port',
+        action='store'
+    )
+    parser.add_argument(
+        '--consul-port',
+        help='Consul API stand-in port',
+        default=18500,
+        type=int,
+        dest='consul_port',
+        action='store'
+    )
+    parser.add_argument(
+        '--latency',
+        help='Injected latency per backend request in seconds',
+        default=0.0,
+        type=float,
+        dest='latency',
+        action='store'
+    )
+    parser.add_argument(
+        '--rollout',
+        help='Seconds until created or updated deployment becomes available',
+        default=0.0,
+        type=float,
+        dest='rollout',
+        action='store'
+    )
+    args = parser.parse_args()
+
+    start(args.kube_port, args.consul_port, args.latency, args.rollout)
+    print('Kubernetes stub on :{}, Consul stub on :{}'.format(
+        args.kube_port, args.consul_port))
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,27 @@
 #         -template k8s-services.ctmpl:k8s-services.json \
 #         -once
 #
+# Plugin arguments are limited in size by the OS (ARG_MAX), with thousands of
+# services render the tree into a file instead and let the plugin read it:
+#
+#     {{- tree "kubernetes/deployments" | explode | toJSON -}}
+#
+#     consul-template \
+#         -consul-addr consul.example.com:8500 \
+#         -template "k8s-deployments.ctmpl:k8s-deployments.json:./k8s-svcgen.py -f k8s-deployments.json > k8s-services.json" \
+#         -once
+#
+# or pipe it through stdin:
+#
+#     ./k8s-svcgen.py < k8s-deployments.json
+#
+# Output is sorted, with -o it's written only if content has changed and
+# -e command (e.g. consul reload) is executed only in that case, with -c
+# services that didn't change since the previous run are taken from cache:
+#
+#     ./k8s-svcgen.py -f k8s-deployments.json -o k8s-services.json \
+#         -c k8s-services.cache -e "consul reload"
+#
 # Now, restart the agent, providing the configuration directory:
 #
 #     # consul agent -dev -config-dir=/etc/consul.d
@@ -28,42 +49,353 @@
 #     Configuration reload triggered
 #
 
-import sys, json
+import re, os, sys, json, argparse, tempfile, subprocess
+from io import StringIO, open
+from hashlib import sha1
+from json.decoder import scanstring
+from json.encoder import encode_basestring_ascii as quote
+
+
+# Bump whenever svc_def() output changes, invalidates existing caches
+CACHE_VERSION = 1
+
+RENDER_FORMAT = '''\
+        {{
+            "name": {},
+            "port": {},
+            "tags": {}
+        }}'''
+
+# Whitespaces between JSON tokens
+WS = re.compile(r'[ \t\n\r]*')
+
+
+class TreeReader(object):
+    """
+    Incremental reader of exploded Consul tree {"ns": {"svc": "<json>"}},
+    input is consumed in chunks so whole tree is never held in memory
+    """
+    def __init__(self, f, chunk_size=65536):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+
+    def fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            return False
+
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+        return True
+
+    def next(self):
+        """
+        Consume next character skipping whitespaces, empty on EOF (output: str)
+        """
+        while True:
+            pos = WS.match(self.buf, self.pos).end()
+            if pos < len(self.buf):
+                self.pos = pos + 1
+                return self.buf[pos]
+            self.pos = pos
+            if not self.fill():
+                return ''
+
+    def eof(self):
+        """
+        Skip whitespaces and check if anything is left to read (output: bool)
+        """
+        if self.next():
+            self.pos -= 1
+            return False
+
+        return True
+
+    def expect(self, chars):
+        c = self.next()
+        if not c or c not in chars:
+            raise ValueError('Expecting {!r} but found {!r}'.format(chars, c))
+
+        return c
+
+    def string(self):
+        """
+        Read and unescape JSON string, opening quote has to be
+        already consumed (output: str)
+        """
+        while True:
+            try:
+                s, self.pos = scanstring(self.buf, self.pos)
+                return s
+            except ValueError:
+                # String continues in the next chunk, unread part of
+                # the buffer is kept so scanning starts over after the quote
+                if not self.fill():
+                    raise
+
+    def members(self):
+        """
+        Iterate over keys of JSON object, value of every key
+        has to be consumed before moving to the next one (output: iter)
+        """
+        self.expect('{')
+        if self.expect('"}') == '}':
+            return
+
+        while True:
+            key = self.string()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+            self.expect('"')
+
+
+def iter_values(tree):
+    """
+    Raw service values from the tree one by one (output: iter)
+    """
+    for ns in tree.members():
+        for name in tree.members():
+            tree.expect('"')
+            yield tree.string()
+
 
-data = sys.argv[1]
+def iter_svcs(tree):
+    """
+    Parse service definitions from the tree one by one (output: iter)
+    """
+    decode = json.JSONDecoder().decode
 
-svcs = []
+    for value in iter_values(tree):
+        yield decode(value)
 
-if data:
-    d = json.loads(data)
 
-    for ns in d.values():
-        for s in ns.values():
-            svc = json.loads(s)
+def svc_def(svc):
+    """
+    Consul service definition of NodePort service (output: dict)
+    """
+    name = svc['metadata']['name']
+    annotations = svc['metadata'].get('annotations')
+    node_port = svc['spec']['ports'][0]['nodePort']
 
-            if svc['spec']['type'] != 'NodePort':
-                continue
+    if annotations is None:
+        tags = None
+    else:
+        tags = []
+        for k,v in annotations.items():
+            constraint = k.split('.')[0]
+            if constraint == 'traefik':
+                tags.append('{}={}'.format(k,v))
+            elif constraint == 'tags':
+                tags += [  tag.strip()  for tag in v.split(',')  ]
 
-            name = svc['metadata']['name']
-            annotations = svc['metadata'].get('annotations')
-            node_port = svc['spec']['ports'][0]['nodePort']
+    return {
+        'name': name,
+        'tags': sorted(tags) if tags is not None else None,
+        'port': node_port
+    }
 
-            if annotations is None:
-                tags = None
+
+def render(d):
+    """
+    Service definition formatted as an item of services list, byte for byte
+    what json.dumps() of the whole document would produce (output: str)
+    """
+    if d['tags'] is None:
+        tags = 'null'
+    elif not d['tags']:
+        tags = '[]'
+    else:
+        tags = '[\n{}\n            ]'.format(',\n'.join(
+            '                ' + quote(tag) for tag in d['tags']
+        ))
+
+    return RENDER_FORMAT.format(quote(d['name']), json.dumps(d['port']), tags)
+
+
+class SvcCache(object):
+    """
+    On-disk cache of rendered Consul service definitions keyed by content
+    hash of the service value, services which didn't change since the
+    previous run are neither parsed nor rendered again, entries of removed
+    services are dropped
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.seen = {}
+        self.hits = 0
+
+        if path is None:
+            return
+
+        try:
+            with open(path, encoding='utf-8') as f:
+                cache = json.load(f)
+            if cache.get('version') == CACHE_VERSION:
+                self.entries = cache['services']
+        except (IOError, OSError, ValueError):
+            pass
+
+    def entry(self, value):
+        """
+        Name, port and rendered definition of NodePort service,
+        None for any other service (output: list)
+        """
+        key = sha1(value.encode('utf-8')).hexdigest()
+
+        if key in self.entries:
+            self.hits += 1
+            e = self.entries[key]
+        else:
+            svc = json.loads(value)
+            if svc['spec']['type'] == 'NodePort':
+                d = svc_def(svc)
+                e = [d['name'], d['port'], render(d)]
             else:
-                tags = []
-                for k,v in annotations.items():
-                    constraint = k.split('.')[0]
-                    if constraint == 'traefik':
-                        tags.append('{}={}'.format(k,v))
-                    elif constraint == 'tags':
-                        tags += [  tag.strip()  for tag in v.split(',')  ]
-
-            svcs.append({
-                'name': name,
-                'tags': tags,
-                'port': node_port
-            })
-
-    services = {'services': svcs}
-    print(json.dumps(services, indent=4, separators=(',', ': ')))
+                e = None
+        self.seen[key] = e
+
+        return e
+
+    def save(self):
+        """
+        Persist entries of the services from the last run
+        """
+        if self.path is None or self.seen == self.entries:
+            return
+
+        write_file(self.path, json.dumps({
+            'version': CACHE_VERSION,
+            'services': self.seen
+        }, sort_keys=True))
+
+
+def generate(tree, cache):
+    """
+    Consul service definitions sorted by name and port, same as
+    json.dumps() of the whole document with sorted keys (output: str)
+    """
+    svcs = [
+        e for e in (cache.entry(value) for value in iter_values(tree))
+        if e is not None
+    ]
+    if not svcs:
+        return '{\n    "services": []\n}'
+    svcs.sort(key=lambda e: (e[0], e[1]))
+
+    return '{\n    "services": [\n' + \
+           ',\n'.join(e[2] for e in svcs) + \
+           '\n    ]\n}'
+
+
+def write_file(path, content):
+    """
+    Atomically replace file content unless it's already the same,
+    returns whether file was written (output: bool)
+    """
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.{}.'.format(os.path.basename(path))
+    )
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                description='Generates Consul service definition from '
+                            'exploded Consul tree passed as argument, '
+                            'file or stdin'
+            )
+    parser.add_argument(
+        '-f', '--file',
+        help='Read tree from file, "-" for stdin',
+        dest='file',
+        action='store'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        help='Write definitions to file instead of stdout, '
+             'file is replaced atomically and only if content has changed',
+        dest='output',
+        action='store'
+    )
+    parser.add_argument(
+        '-c', '--cache',
+        help='Cache file of previously generated definitions',
+        dest='cache',
+        action='store'
+    )
+    parser.add_argument(
+        '-e', '--exec',
+        help='Run command after output file has changed, '
+             'e.g. "consul reload"',
+        dest='cmd',
+        action='store'
+    )
+    parser.add_argument(
+        'data',
+        help='Tree as JSON string (consul-template plugin argument)',
+        nargs='?'
+    )
+    args = parser.parse_args()
+
+    if args.data == '-':
+        args.file, args.data = '-', None
+
+    if args.data is not None:
+        if not args.data:
+            return
+        f = StringIO(args.data if isinstance(args.data, type(u'')) else
+                     args.data.decode('utf-8'))
+    elif args.file and args.file != '-':
+        f = open(args.file, encoding='utf-8')
+    else:
+        f = sys.stdin
+
+    tree = TreeReader(f)
+    cache = SvcCache(args.cache)
+    try:
+        # Empty tree, nothing to generate
+        if tree.eof():
+            return
+
+        output = generate(tree, cache)
+    finally:
+        f.close()
+
+    cache.save()
+
+    if args.output is None:
+        print(output)
+    elif write_file(args.output, output + '\n') and args.cmd:
+        sys.exit(subprocess.call(args.cmd, shell=True))
+
+
+if __name__ == '__main__':
+    main()
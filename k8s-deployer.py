@@ -2,14 +2,40 @@
 
 import sys
 import os
+
+# Event loop (gevent) server mode needs the standard library to be patched
+# before bottle and requests are imported, otherwise request state and
+# backend sockets are not greenlet aware, so mode is looked up this early
+if __name__ == '__main__' and 'gevent' in [
+        b for a, b in zip(sys.argv, sys.argv[1:]) if a in ['-s', '--server']
+    ] + [a.split('=', 1)[1] for a in sys.argv if a.startswith('--server=')]:
+    try:
+        from gevent import monkey
+    except ImportError:
+        print('gevent server mode requires gevent package to be installed')
+        sys.exit(4)
+    monkey.patch_all()
+
+import re
 import json
 import argparse
 import requests
 import time
-import validictory
-from base64 import b64decode
+import math
+import zlib
+import threading
+from hashlib import sha256
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from base64 import b64decode, b64encode
 from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED
+from concurrent.futures import wait as wait_futures
 from bottle import get, post, put, delete, abort, request, response, run
+from bottle import HTTPError, install
+from requests.compat import urlencode, urlparse
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 
 __prog__ = os.path.splitext(os.path.basename(__file__))[0]
@@ -19,16 +45,179 @@ __date__ = '2017/03/20'
 __description__ = 'Kubernetes deployer API with Consul registration'
 
 
-# Kubernetes API groups and versions
+# Kubernetes API groups and versions, used only until (or unless)
+# API discovery of the cluster succeeds
 K8S_API = {
     'services': 'api/v1',
-    'deployments': 'apis/apps/v1beta1',
-    'replicasets': 'apis/extensions/v1beta1'
+    'deployments': 'apis/apps/v1',
+    'replicasets': 'apis/apps/v1'
 }
 
 # Consul key/value API
 CONSUL_KV_API = 'v1/kv'
 
+# Consul transaction API and max number of operations per transaction
+CONSUL_TXN_API = 'v1/txn'
+CONSUL_TXN_MAX_OPS = 64
+# Max size of base64 encoded values per transaction (txn_max_req_len is 512KB)
+CONSUL_TXN_MAX_BYTES = 393216
+# Transaction operations which change nothing
+KV_READ_VERBS = ['get', 'check-index', 'check-not-exists']
+
+# Consul agent API and meta data of services registered through it
+CONSUL_AGENT_API = 'v1/agent'
+CONSUL_AGENT_META = {'managed-by': 'k8s-deployer'}
+
+# Pooled HTTP sessions per backend (output of create_session() keyed by base URL)
+SESSIONS = {}
+
+# Kubernetes API discovery per cluster (ApiDiscovery objects keyed by base URL)
+K8S_APIS = {}
+
+# Consul K/V caches per Consul host (KVCache objects keyed by base URL)
+KV_CACHES = {}
+
+# Specification ID, microseconds since epoch (fixed width) and UUID, so
+# revisions listed by Consul in lexicographic order are oldest first
+REVISION_ID = re.compile(
+    r'^[0-9]{16}_[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
+)
+
+# Alpha and beta Kubernetes API versions
+PRERELEASE = re.compile(r'v[0-9]+(alpha|beta)[0-9]*$')
+
+# Markers of compressed and chunked Consul values,
+# values without a marker are plain JSON
+KV_ZLIB_MARKER = b'zlib:'
+KV_CHUNKS_MARKER = b'chunks:'
+
+# Content blobs start with unset specification ID, raw responses
+# replace it with ID of the revision
+SPEC_BLOB_PREFIX = b'{"id":null,'
+
+# Media type of specification served from raw bytes stored in Consul
+SPEC_RAW_MEDIA_TYPE = 'application/vnd.k8s-deployer.raw+json'
+
+# Storage format of Consul values (set from consul.storage config),
+# only values under the prefixes (specifications and their content blobs)
+# are compressed and chunked, the rest (e.g. deployments tree read
+# by consul-template) is minified JSON
+STORAGE = {
+    'prefix': None,
+    'blob_prefix': None,
+    'chunk_prefix': None,
+    'compression': None,
+    'level': 6,
+    'min_size': 1024,
+    'chunk_size': 262144
+}
+
+
+class Metrics(object):
+    """
+    Registry of latency histograms and gauges exposed in
+    Prometheus text format, observations cost one lock and one bisect
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = OrderedDict()
+        self.histograms = {}
+        self.gauges = OrderedDict()
+
+    def histogram(self, name, help_text):
+        """
+        Register histogram (labeled series are created on first observation)
+        """
+        self.help[name] = help_text
+
+    def gauge(self, name, help_text, func, metric_type='gauge'):
+        """
+        Register gauge (or counter) which values are collected on scrape
+        from function returning list of (labels, value) tuples
+        """
+        self.gauges[name] = (help_text, metric_type, func)
+
+    def observe(self, name, labels, value):
+        """
+        Record observation, labels are tuple of (name, value) pairs
+        """
+        i = bisect_left(self.BUCKETS, value)
+        with self.lock:
+            series = self.histograms.get((name, labels))
+            if series is None:
+                series = [0] * (len(self.BUCKETS) + 1) + [0.0]
+                self.histograms[(name, labels)] = series
+            series[i] += 1
+            series[-1] += value
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+
+        return '{' + ','.join(
+            '{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                             .replace('"', '\\"').replace('\n', '\\n'))
+            for k, v in labels
+        ) + '}'
+
+    def render(self):
+        """
+        Render all metrics in Prometheus text format (output: str)
+        """
+        with self.lock:
+            histograms = sorted(
+                (k, list(v)) for k, v in self.histograms.items()
+            )
+
+        lines = []
+        for name, help_text in self.help.items():
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} histogram'.format(name))
+            for (series_name, labels), series in histograms:
+                if series_name != name:
+                    continue
+                total = 0
+                for le, count in zip(self.BUCKETS + ('+Inf',), series[:-1]):
+                    total += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, self.format_labels(labels, [('le', le)]), total
+                    ))
+                lines.append('{}_sum{} {}'.format(
+                    name, self.format_labels(labels), series[-1]
+                ))
+                lines.append('{}_count{} {}'.format(
+                    name, self.format_labels(labels), total
+                ))
+
+        for name, (help_text, metric_type, func) in self.gauges.items():
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for labels, value in func():
+                lines.append('{}{} {}'.format(
+                    name, self.format_labels(labels), value
+                ))
+
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+METRICS.histogram(
+    'k8s_deployer_http_request_duration_seconds',
+    'Latency of requests served by k8s-deployer per route and method'
+)
+METRICS.histogram(
+    'k8s_deployer_backend_request_duration_seconds',
+    'Latency of requests sent to Kubernetes and Consul APIs'
+)
+METRICS.histogram(
+    'k8s_deployer_validation_duration_seconds',
+    'Time spent in specification validation'
+)
+
 
 def load_config(config_file):
     """
@@ -51,10 +240,58 @@ def load_config(config_file):
         sys.exit(1)
 
 
-def req(method, url, headers={}, payload=None, status_code=False, timeout=30):
+def create_session(host, pool_size=10, keep_alive=True, max_retries=3,
+                   backoff_factor=0.2, backend=None):
+    """
+    Create pooled keep-alive HTTP session for specified backend host,
+    session will be used by req() for all requests sent to this host
+    (output: requests.Session)
+    """
+    retries = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[502, 503, 504],
+            raise_on_status=False
+        )
+    # Block instead of opening throwaway connections when the pool is
+    # exhausted, requests.Session is safe to share between worker threads
+    adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=retries,
+            pool_block=True
+        )
+
+    session = requests.Session()
+    session.verify = False
+    session.backend = backend or host
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+
+    SESSIONS[host] = session
+
+    return session
+
+
+def get_session(url):
     """
-    Request function with error handlers (output: dict)
+    Return pooled session registered for the host part of the URL
+    or requests module itself if there is none (output: requests.Session)
     """
+    host = '/'.join(url.split('/', 3)[:3])
+
+    return SESSIONS.get(host, requests)
+
+
+def req(method, url, headers={}, payload=None, status_code=False, timeout=30,
+        raw=False):
+    """
+    Request function with error handlers, with raw response object
+    is returned instead of decoded body (output: dict)
+    """
+    session = get_session(url)
     pass_headers = {}
     const_headers = {
         'User-Agent': '{}/{}'.format(
@@ -64,21 +301,19 @@ def req(method, url, headers={}, payload=None, status_code=False, timeout=30):
     pass_headers.update(headers)
     pass_headers.update(const_headers)
 
+    r = None
+    start = time.time()
     try:
-        if method in ['GET', 'DELETE']:
-            r = requests.request(
+        if method == 'GET' or method == 'DELETE' and payload is None:
+            r = session.request(
                     method, url,
                     headers=pass_headers, timeout=timeout, verify=False
                 )
-        elif method in ['POST', 'PUT', 'PATCH']:
-            ### built-in json parameter does not support pretty-printing
-            # r = requests.request(method, url, json=payload)
-            r = requests.request(
+        elif method in ['POST', 'PUT', 'PATCH', 'DELETE']:
+            r = session.request(
                     method, url,
                     headers=pass_headers, timeout=timeout, verify=False,
-                    data=json.dumps(
-                        payload, indent=4, separators=(',', ': ')
-                    )
+                    data=json.dumps(payload, separators=(',', ':'))
                 )
 
         if status_code:
@@ -94,72 +329,631 @@ def req(method, url, headers={}, payload=None, status_code=False, timeout=30):
             }
 
         r.raise_for_status()
+        if raw:
+            return r
+
+        # Consul agent API replies with an empty body
+        if not r.content:
+            return None
     except requests.exceptions.HTTPError as e:
         abort(r.status_code, 'HTTPError: {}'.format(e))
     except requests.exceptions.ConnectionError as e:
         abort(504, 'ConnectionError: {}'.format(e))
+    finally:
+        METRICS.observe(
+            'k8s_deployer_backend_request_duration_seconds',
+            (
+                ('backend', getattr(session, 'backend', 'unknown')),
+                ('method', method),
+                ('code', r.status_code if r is not None else 'error')
+            ),
+            time.time() - start
+        )
 
     return r.json()
 
 
-def spec_validator(data):
+def parallel_map(func, items, workers=1):
     """
-    Validate JSON data
+    Apply function to every item using bounded number of threads,
+    results are returned and the first error is raised in items order
+    (output: list)
     """
-    schema = {
-        'type': 'object',
-        'properties': {
-            'id': {
-                'type': ['null', 'string']
-            },
-            'namespace': {
-                'type': ['null', 'string']
-            },
-            'objects': {
-                'type': 'object',
-                'properties': {
-                    'deployments': {
-                        'type': 'object',
-                        'properties': {
-                            'specification': {
-                                'type': 'object',
-                                'properties': {
-                                    'kind': {
-                                        'type': ['string']
-                                    }
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        futures = [executor.submit(func, item) for item in items]
+
+        return [f.result() for f in futures]
+
+
+def call_outcome(func, item):
+    """
+    Call function and capture its result or error along with
+    the time it took (output: dict)
+    """
+    start = time.time()
+    outcome = {'state': 'succeeded', 'result': None, 'error': None}
+    try:
+        outcome['result'] = func(item)
+    except HTTPError as e:
+        outcome['state'] = 'failed'
+        outcome['error'] = {'status': e.status_code, 'message': e.body}
+    except Exception as e:
+        outcome['state'] = 'failed'
+        outcome['error'] = {'status': 500, 'message': str(e)}
+    outcome['seconds'] = round(time.time() - start, 3)
+
+    return outcome
+
+
+def fan_out(clusters, func):
+    """
+    Call function for every cluster concurrently, failure on one cluster
+    doesn't affect the others (output: OrderedDict of outcomes keyed
+    by cluster name)
+    """
+    return OrderedDict(zip(
+        [cluster['name'] for cluster in clusters],
+        parallel_map(
+            lambda cluster: call_outcome(func, cluster),
+            clusters, len(clusters)
+        )
+    ))
+
+
+def run_batch(items, func, parallelism=10, namespace_parallelism=None):
+    """
+    Call function for every item (dict with key, namespace and depends_on
+    keys) as soon as all of its dependencies have succeeded, at most
+    parallelism calls run at once and at most namespace_parallelism of them
+    in the same namespace, items depending on failed ones are skipped
+    (output: OrderedDict of outcomes keyed by item key)
+    """
+    pending = OrderedDict((item['key'], item) for item in items)
+    outcomes = OrderedDict((key, None) for key in pending)
+    running = {}
+    namespaces = {}
+
+    with ThreadPoolExecutor(max_workers=max(parallelism, 1)) as executor:
+        while pending or running:
+            progress = False
+            for key, item in list(pending.items()):
+                deps = [outcomes[dep] for dep in item['depends_on']]
+                if any(d is not None and d['state'] != 'succeeded'
+                       for d in deps):
+                    del pending[key]
+                    outcomes[key] = {
+                        'state': 'skipped',
+                        'result': None,
+                        'error': {
+                            'status': 424,
+                            'message': 'Dependency has not succeeded'
+                        },
+                        'seconds': 0
+                    }
+                    progress = True
+                    continue
+
+                if None in deps:
+                    continue
+                if len(running) >= parallelism:
+                    break
+                ns = item['namespace']
+                if namespaces.get(ns, 0) >= (namespace_parallelism or
+                                             parallelism):
+                    continue
+
+                del pending[key]
+                namespaces[ns] = namespaces.get(ns, 0) + 1
+                running[executor.submit(call_outcome, func, item)] = item
+                progress = True
+
+            if not running:
+                if not progress:
+                    raise ValueError('Circular dependency between {}'.format(
+                        ', '.join(pending)
+                    ))
+                # Skipped items may unblock skipping of their dependents
+                continue
+
+            done, _ = wait_futures(
+                list(running), return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                item = running.pop(future)
+                namespaces[item['namespace']] -= 1
+                outcomes[item['key']] = future.result()
+
+    return outcomes
+
+
+# Python 2/3 compatible string type
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
+
+# JSON types supported by compile_schema()
+SCHEMA_TYPES = {
+    'null': (type(None),),
+    'boolean': (bool,),
+    'string': string_types,
+    'object': (dict,),
+    'array': (list,)
+}
+
+
+def compile_schema(schema, field='data'):
+    """
+    Compile schema into validation function which raises ValueError on
+    the first violation, supported keywords are type, properties (required
+    by default), additionalProperties, items and specification, later
+    validates Kubernetes object or every item of the object of kind List
+    (output: function)
+    """
+    types = schema.get('type')
+    if isinstance(types, string_types):
+        types = [types]
+    py_types = sum([SCHEMA_TYPES[t] for t in types or []], ())
+
+    props = [
+        (
+            name,
+            compile_schema(prop, '{}.{}'.format(field, name)),
+            prop.get('required', True)
+        )
+        for name, prop in schema.get('properties', {}).items()
+    ]
+
+    allowed = None
+    if schema.get('additionalProperties', True) is False:
+        allowed = set(schema.get('properties', {}))
+
+    validate_items = None
+    if 'items' in schema:
+        validate_items = compile_schema(schema['items'], field + '[]')
+
+    validate_object = validate_list = None
+    if 'specification' in schema:
+        validate_object = compile_schema(schema['specification'], field)
+        validate_list = compile_schema({
+            'properties': {
+                'items': {
+                    'type': 'array',
+                    'items': schema['specification']
+                }
+            }
+        }, field)
+
+    def validate(data):
+        if py_types and not isinstance(data, py_types):
+            raise ValueError(
+                "Value for field '{}' is not of type {}".format(
+                    field, ' or '.join(types)
+                )
+            )
+
+        if isinstance(data, dict):
+            for name, validate_prop, required in props:
+                if name in data:
+                    validate_prop(data[name])
+                elif required:
+                    raise ValueError(
+                        "Required field '{}.{}' is missing".format(field, name)
+                    )
+
+            if allowed is not None:
+                extra = [k for k in data if k not in allowed]
+                if extra:
+                    raise ValueError(
+                        "Additional properties {} are not allowed in field "
+                        "'{}'".format(', '.join(sorted(extra)), field)
+                    )
+
+        if validate_items is not None and isinstance(data, list):
+            for item in data:
+                validate_items(item)
+
+        if validate_object is not None:
+            if isinstance(data, dict) and data.get('kind') == 'List':
+                validate_list(data)
+            else:
+                validate_object(data)
+
+    return validate
+
+
+# Fields of Kubernetes objects dereferenced by k8s-deployer
+K8S_OBJECT_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'kind': {
+            'type': 'string',
+            'required': False
+        },
+        'metadata': {
+            'type': 'object',
+            'properties': {
+                'name': {
+                    'type': 'string'
+                }
+            }
+        }
+    }
+}
+
+K8S_DEPLOYMENT_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'kind': {
+            'type': 'string',
+            'required': False
+        },
+        'metadata': K8S_OBJECT_SCHEMA['properties']['metadata'],
+        'spec': {
+            'type': 'object',
+            'properties': {
+                'selector': {
+                    'type': 'object',
+                    'properties': {
+                        'matchLabels': {
+                            'type': 'object',
+                            'required': False
+                        }
+                    }
+                }
+            }
+        }
+    }
+}
+
+SPEC_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'id': {
+            'type': ['null', 'string']
+        },
+        'namespace': {
+            'type': ['null', 'string']
+        },
+        'objects': {
+            'type': 'object',
+            'properties': {
+                'deployments': {
+                    'type': 'object',
+                    'properties': {
+                        'specification': {
+                            'type': 'object',
+                            'properties': {
+                                'kind': {
+                                    'type': 'string'
                                 }
-                            }
+                            },
+                            'specification': K8S_DEPLOYMENT_SCHEMA
                         }
-                    },
-                    'services': {
-                        'type': 'object',
-                        'properties': {
-                            'specification': {
-                                'type': 'object',
-                                'properties': {
-                                    'kind': {
-                                        'type': ['string']
-                                    }
+                    }
+                },
+                'services': {
+                    'type': 'object',
+                    'properties': {
+                        'specification': {
+                            'type': 'object',
+                            'properties': {
+                                'kind': {
+                                    'type': 'string'
                                 }
-                            }
+                            },
+                            'specification': K8S_OBJECT_SCHEMA
                         }
                     }
+                }
+            },
+            'additionalProperties': False
+        }
+    },
+    'additionalProperties': False
+}
+
+# Specification schema is compiled only once
+SPEC_VALIDATOR = compile_schema(SPEC_SCHEMA)
+
+BATCH_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'deployments': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'namespace': {
+                        'type': 'string'
+                    },
+                    'service_name': {
+                        'type': 'string'
+                    },
+                    'service_id': {
+                        'type': 'string',
+                        'required': False
+                    },
+                    'depends_on': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'string'
+                        },
+                        'required': False
+                    }
                 },
-                "additionalProperties": False
+                'additionalProperties': False
             }
-        },
-        "additionalProperties": False
-    }
+        }
+    },
+    'additionalProperties': False
+}
+
+BATCH_VALIDATOR = compile_schema(BATCH_SCHEMA)
+
+
+def spec_validator(data):
+    """
+    Validate JSON data
+    """
+    start = time.time()
+    try:
+        SPEC_VALIDATOR(data)
+    except ValueError as e:
+        abort(422, 'Bad JSON schema: {}'.format(e))
+    finally:
+        METRICS.observe(
+            'k8s_deployer_validation_duration_seconds', (),
+            time.time() - start
+        )
+
 
+def batch_items(deployments):
+    """
+    Validate batch of deployments and turn it into scheduler items keyed
+    by <namespace>/<service_name>, dependencies are referenced by the same
+    keys and have to be part of the batch without forming a cycle
+    (output: list)
+    """
     try:
-        validictory.validate(data, schema)
+        BATCH_VALIDATOR({'deployments': deployments})
     except ValueError as e:
         abort(422, 'Bad JSON schema: {}'.format(e))
 
+    items = OrderedDict()
+    for d in deployments:
+        key = '{}/{}'.format(d['namespace'], d['service_name'])
+        if key in items:
+            abort(422, 'Service {} is listed more than once'.format(key))
+        items[key] = dict(d, key=key, depends_on=d.get('depends_on') or [])
+
+    for key, item in items.items():
+        unknown = [dep for dep in item['depends_on'] if dep not in items]
+        if unknown:
+            abort(422, 'Service {} depends on {} which {} not in the batch'.format(
+                key, ', '.join(unknown), 'is' if len(unknown) == 1 else 'are'
+            ))
+
+    # Kahn's algorithm, whatever can't be ordered is part of a cycle
+    deps = dict((key, set(item['depends_on'])) for key, item in items.items())
+    ordered = set()
+    ready = [key for key, d in deps.items() if not d]
+    while ready:
+        key = ready.pop()
+        ordered.add(key)
+        for other, d in deps.items():
+            if key in d:
+                d.discard(key)
+                if not d and other not in ordered:
+                    ready.append(other)
+    if len(ordered) < len(items):
+        abort(422, 'Circular dependency between {}'.format(', '.join(
+            key for key in items if key not in ordered
+        )))
+
+    return list(items.values())
+
+
+class ApiDiscovery(object):
+    """
+    Group versions serving Kubernetes resources, discovered at startup and
+    refreshed in background once TTL expires, so resolving API path costs
+    no requests, optionally persisted on disk to skip discovery on restart
+    """
+    def __init__(self, k8s_host, k8s_api_headers, ttl=3600, cache_file=None):
+        self.k8s_host = k8s_host
+        self.k8s_api_headers = k8s_api_headers
+        self.ttl = ttl
+        self.cache_file = cache_file
+        # Resource name to group versions serving it, most preferred first
+        self.resources = {}
+        # Group name (empty for core group) to all of its served versions
+        self.versions = {}
+        self.expires = 0
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Load discovery persisted by previous run, returns whether
+        it's still fresh (output: bool)
+        """
+        if self.cache_file is None:
+            return False
+
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+            if cache['host'] != self.k8s_host:
+                return False
+            self.update(cache['resources'], cache['versions'], cache['fetched'])
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+
+        return time.time() < self.expires
+
+    def save(self, fetched):
+        """
+        Persist discovery atomically
+        """
+        if self.cache_file is None:
+            return
+
+        tmp = '{}.{}'.format(self.cache_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({
+                'host': self.k8s_host,
+                'fetched': fetched,
+                'resources': self.resources,
+                'versions': self.versions
+            }, f)
+        os.rename(tmp, self.cache_file)
+
+    def update(self, resources, versions, fetched):
+        with self.lock:
+            self.resources = resources
+            self.versions = versions
+            self.expires = fetched + self.ttl
+
+    def discover(self):
+        """
+        Fetch served group versions and resources of the preferred version
+        of every group, core group first and then the others in the order
+        API server prefers them, stable versions ahead of alpha and beta
+        ones (e.g. apps/v1 ahead of deprecated extensions/v1beta1)
+        """
+        fetched = time.time()
+        headers = self.k8s_api_headers
+
+        versions = {
+            '': req('GET', self.k8s_host + '/api', headers)['versions']
+        }
+        preferred = versions[''][:1]
+        for group in req('GET', self.k8s_host + '/apis', headers)['groups']:
+            versions[group['name']] = [
+                v['groupVersion'] for v in group['versions']
+            ]
+            preferred.append(group['preferredVersion']['groupVersion'])
+
+        def fetch(gv):
+            try:
+                return req('GET', '{}/{}'.format(
+                    self.k8s_host, api_path(gv)
+                ), headers)
+            except HTTPError as e:
+                # Unavailable aggregated API (e.g. metrics.k8s.io) must not
+                # prevent discovery of the others
+                print('API discovery of {} on {} failed, {}'.format(
+                    gv, self.k8s_host, e.body
+                ))
+                return {}
+
+        resource_lists = parallel_map(fetch, preferred, len(preferred))
+
+        resources = {}
+        for gv, resource_list in zip(preferred, resource_lists):
+            for resource in resource_list.get('resources') or []:
+                # Subresources (e.g. deployments/scale) are not needed
+                if '/' not in resource['name']:
+                    resources.setdefault(resource['name'], []).append(gv)
+        for group_versions in resources.values():
+            group_versions.sort(
+                key=lambda gv: PRERELEASE.search(gv) is not None
+            )
+
+        self.update(resources, versions, fetched)
+        self.save(fetched)
+
+    def refresh(self):
+        """
+        Rediscover API, failures are retried after a minute at the latest
+        while previous discovery stays in use
+        """
+        try:
+            self.discover()
+        except (HTTPError, KeyError, ValueError, IOError, OSError) as e:
+            with self.lock:
+                self.expires = time.time() + min(self.ttl, 60)
+            print('API discovery of {} failed, {}'.format(
+                self.k8s_host, getattr(e, 'body', e)
+            ))
+        finally:
+            self.refreshing = False
+
+    def start(self):
+        """
+        Discover API unless fresh discovery was persisted by previous run
+        """
+        if not self.load():
+            self.refreshing = True
+            self.refresh()
+
+    def path(self, resource, api_version=None):
+        """
+        API path serving the resource, object's own API version is used
+        when it's served, None if resource hasn't been discovered
+        (output: str)
+        """
+        if time.time() >= self.expires:
+            with self.lock:
+                refresh = not self.refreshing
+                self.refreshing = True
+            if refresh:
+                thread = threading.Thread(
+                    target=self.refresh, name='api-discovery'
+                )
+                thread.daemon = True
+                thread.start()
+
+        group_versions = self.resources.get(resource)
+        if not group_versions:
+            return None
+
+        if api_version is not None:
+            group = api_version.split('/')[0] if '/' in api_version else ''
+            if (api_version in self.versions.get(group, []) and
+                    group in [gv.split('/')[0] if '/' in gv else ''
+                              for gv in group_versions]):
+                return api_path(api_version)
+
+        return api_path(group_versions[0])
+
+
+def api_path(group_version):
+    """
+    API path of the group version (output: str)
+    """
+    if '/' not in group_version:
+        return 'api/{}'.format(group_version)
+
+    return 'apis/{}'.format(group_version)
+
+
+def api_url(k8s_host, resource, namespace=None, name=None, api_version=None):
+    """
+    URL of Kubernetes resource (within the namespace) or of the object,
+    API path is resolved through API discovery of the cluster (output: str)
+    """
+    discovery = K8S_APIS.get(k8s_host)
+    path = discovery.path(resource, api_version) if discovery else None
+
+    url = '{}/{}'.format(k8s_host, path or K8S_API[resource])
+    if namespace is not None:
+        url += '/namespaces/{}'.format(namespace)
+    url += '/{}'.format(resource)
+    if name is not None:
+        url += '/{}'.format(name)
+
+    return url
+
 
 def fetch_svc(k8s_host, **kwargs):
     """
-    Fetch named service definition from Kubernetes (output: dict)
+    Fetch named service definition from Kubernetes, concurrent
+    fetches of the same service share one request (output: dict)
     """
     pass_headers = {}
     if 'k8s_api_headers' in kwargs:
@@ -170,18 +964,87 @@ def fetch_svc(k8s_host, **kwargs):
     namespace = kwargs['namespace']
     service_name = kwargs['service_name']
 
-    url = '{}/{}/namespaces/{}/{}/{}'.format(
-                k8s_host, K8S_API['services'],
-                namespace, 'services', service_name
-            )
-    svc = req('GET', url, pass_headers)
+    url = api_url(k8s_host, 'services', namespace, service_name)
+    svc = FLIGHTS['kubernetes'].do(
+            (url, tuple(sorted(pass_headers.items()))),
+            lambda: req('GET', url, pass_headers)
+        )
 
-    if svc['spec']['type'] != 'NodePort':
+    if not is_nodeport(svc):
         abort(422, 'Only services of type NodePort are supported')
 
     return svc
 
 
+def list_svcs(k8s_host, **kwargs):
+    """
+    List service definitions of type NodePort from Kubernetes namespace
+    or from all namespaces if namespace is not specified (output: list)
+    """
+    pass_headers = {}
+    if 'k8s_api_headers' in kwargs:
+        headers = kwargs.pop('k8s_api_headers')
+
+    pass_headers.update(headers)
+
+    namespace = kwargs.get('namespace')
+    params = dict(
+        (k, kwargs[k]) for k in ['labelSelector', 'fieldSelector']
+        if kwargs.get(k)
+    )
+
+    url = api_url(k8s_host, 'services', namespace)
+    if params:
+        url += '?' + urlencode(params)
+
+    svcs = []
+    for svc in req('GET', url, pass_headers)['items']:
+        if is_nodeport(svc):
+            # Items of the list are missing these, unlike single object
+            svc.setdefault('kind', 'Service')
+            svc.setdefault('apiVersion', 'v1')
+            svcs.append(svc)
+
+    return svcs
+
+
+def watch_events(url, headers, resource_version, timeout=300):
+    """
+    Follow Kubernetes watch API of the collection from the specified
+    resourceVersion, events are yielded as soon as they arrive (output: iter)
+    """
+    url = '{}?{}'.format(url, urlencode({
+            'watch': 'true',
+            'resourceVersion': resource_version,
+            'allowWatchBookmarks': 'true',
+            'timeoutSeconds': max(1, int(math.ceil(timeout)))
+        }))
+    pass_headers = dict(headers)
+    pass_headers['User-Agent'] = '{}/{}'.format(__prog__, __version__)
+
+    # Watch holds its connection until it expires, pooled sessions
+    # are left for regular requests
+    r = requests.get(
+            url, headers=pass_headers, stream=True, verify=False,
+            timeout=(10, timeout + 30)
+        )
+    r.raise_for_status()
+
+    try:
+        for line in r.iter_lines(chunk_size=None):
+            if line:
+                yield json.loads(line)
+    finally:
+        r.close()
+
+
+def is_nodeport(svc):
+    """
+    Check whether service is of type NodePort (output: bool)
+    """
+    return svc['spec'].get('type') == 'NodePort'
+
+
 def create_object(k8s_host, **kwargs):
     """
     Create deployment and service objects on Kubernetes (output: list)
@@ -192,153 +1055,1709 @@ def create_object(k8s_host, **kwargs):
 
     pass_headers.update(headers)
 
+    parallelism = kwargs.get('parallelism', 1)
     namespace = kwargs['namespace']
     objects = kwargs['objects']
 
     svcs = []
-    for obj in objects:
-        api_path = K8S_API[obj]
-        url = '{}/{}/namespaces/{}/{}'.format(
-                    k8s_host, api_path,
-                    namespace, obj
-                )
-
+    # Deployments have to be created before services
+    for obj in [o for o in ['deployments', 'services'] if o in objects]:
         if objects[obj]['specification']['kind'] == 'List':
             specs = objects[obj]['specification']['items']
         else:
             specs = [objects[obj]['specification']]
 
-        for spec in specs:
-            payload = req('POST', url, pass_headers, payload=spec)
-            if obj == 'services':
-                svcs.append(payload)
+        payloads = parallel_map(
+                lambda spec: req(
+                    'POST',
+                    api_url(k8s_host, obj, namespace,
+                            api_version=spec.get('apiVersion')),
+                    pass_headers, payload=spec
+                ),
+                specs, parallelism
+            )
+        if obj == 'services':
+            svcs.extend(payloads)
 
     return svcs
 
 
-def scale_down(k8s_host, **kwargs):
+def merge_patch(old, new):
+    """
+    JSON merge patch (RFC 7386) which turns old object into the new one,
+    lists are replaced as a whole (output: dict)
+    """
+    patch = {}
+    for k in set(old) | set(new):
+        if k not in new:
+            patch[k] = None
+        elif old.get(k) != new[k]:
+            if isinstance(old.get(k), dict) and isinstance(new[k], dict):
+                patch[k] = merge_patch(old[k], new[k])
+            else:
+                patch[k] = new[k]
+
+    return patch
+
+
+def spec_objects(objects, obj):
+    """
+    Objects of the specified type from specification keyed by name
+    (output: OrderedDict)
+    """
+    if obj not in objects:
+        return OrderedDict()
+
+    spec = objects[obj]['specification']
+    specs = spec['items'] if spec['kind'] == 'List' else [spec]
+
+    return OrderedDict((s['metadata']['name'], s) for s in specs)
+
+
+def update_object(k8s_host, deployed, **kwargs):
     """
-    Scale down number of replicas to 0
+    Bring Kubernetes objects from deployed specification in line with the
+    new one, new objects are created, changed ones are patched with merge
+    patch of the two specifications, removed ones are deleted and unchanged
+    ones are not touched at all, returns created or patched services and
+    report per object type (output: tuple)
     """
     pass_headers = {}
     if 'k8s_api_headers' in kwargs:
         headers = kwargs.pop('k8s_api_headers')
 
     pass_headers.update(headers)
-    pass_headers.update({
-        'Content-Type': 'application/strategic-merge-patch+json'
-    })
-    payload = {
-        'spec': {
-            'replicas': 0
+    patch_headers = dict(pass_headers)
+    patch_headers['Content-Type'] = 'application/merge-patch+json'
+
+    parallelism = kwargs.get('parallelism', 1)
+    namespace = kwargs['namespace']
+    objects = kwargs['objects']
+
+    svcs = []
+    report = {}
+    # Deployments have to be created before services
+    for obj in ['deployments', 'services']:
+        old = spec_objects(deployed['objects'], obj)
+        new = spec_objects(objects, obj)
+
+        def apply(name):
+            spec = new[name]
+            url = api_url(
+                    k8s_host, obj, namespace,
+                    api_version=spec.get('apiVersion')
+                )
+            if name not in old:
+                return 'created', req('POST', url, pass_headers, payload=spec)
+
+            r = req(
+                    'PATCH', '{}/{}'.format(url, name), patch_headers,
+                    payload=merge_patch(old[name], spec), status_code=True
+                )
+            if r['status_code'] == 404:
+                # Object was removed in the meantime
+                return 'created', req('POST', url, pass_headers, payload=spec)
+            if r['status_code'] != 200:
+                abort(r['status_code'], 'Unable to patch {} {}'.format(
+                    obj, name
+                ))
+
+            return 'updated', r['payload']
+
+        changed = [name for name in new if old.get(name) != new[name]]
+        results = parallel_map(apply, changed, parallelism)
+
+        not_found = []
+        for name in [name for name in old if name not in new]:
+            r = req('DELETE', '{}?propagationPolicy=Foreground'.format(
+                api_url(
+                    k8s_host, obj, namespace, name,
+                    api_version=old[name].get('apiVersion')
+                )
+            ), pass_headers, status_code=True)
+            if r['status_code'] == 404:
+                # Object was removed in the meantime, nothing to delete
+                not_found.append(name)
+            elif r['status_code'] not in [200, 202]:
+                abort(r['status_code'], 'Unable to delete {} {}'.format(
+                    obj, name
+                ))
+
+        report[obj] = {
+            'created': [n for n, (a, _) in zip(changed, results)
+                        if a == 'created'],
+            'updated': [n for n, (a, _) in zip(changed, results)
+                        if a == 'updated'],
+            'unchanged': [n for n in new if n not in changed],
+            'deleted': [
+                n for n in old if n not in new and n not in not_found
+            ],
+            'not found': not_found
         }
-    }
-    api_path = K8S_API['deployments']
+        if obj == 'services':
+            svcs.extend(payload for _, payload in results)
+
+    return svcs, report
+
+
+def is_rolled_out(deployment):
+    """
+    Check whether all replicas of the deployment are updated and available,
+    same conditions as used by kubectl rollout status (output: bool)
+    """
+    status = deployment.get('status', {})
+    replicas = deployment.get('spec', {}).get('replicas', 1)
+    updated = status.get('updatedReplicas', 0)
+
+    return (
+        status.get('observedGeneration', 0) >=
+        deployment['metadata'].get('generation', 0) and
+        updated >= replicas and
+        status.get('replicas', 0) <= updated and
+        status.get('availableReplicas', 0) >= updated
+    )
+
+
+def wait_deployments(k8s_host, **kwargs):
+    """
+    Wait until all deployments from the specification are rolled out,
+    deployments of the namespace are listed once and then followed through
+    a single watch, returns seconds from started until every deployment
+    became ready, None if it didn't in time (output: dict)
+    """
+    headers = kwargs.get('k8s_api_headers', {})
     namespace = kwargs['namespace']
-    specs = kwargs['objects']['deployments']['specification']
+    objects = kwargs['objects']
+    started = kwargs.get('started') or time.time()
+    deadline = time.time() + kwargs.get('timeout', 300)
+
+    if 'deployments' not in objects:
+        return {}
+
+    spec = objects['deployments']['specification']
+    specs = spec['items'] if spec['kind'] == 'List' else [spec]
+    waiting = set(s['metadata']['name'] for s in specs)
+    ready = dict((name, None) for name in waiting)
+
+    url = api_url(k8s_host, 'deployments', namespace)
+
+    def check(deployment):
+        name = deployment['metadata']['name']
+        # Watch timeout has a granularity of seconds
+        if time.time() > deadline:
+            return
+        if name in waiting and is_rolled_out(deployment):
+            waiting.discard(name)
+            ready[name] = round(time.time() - started, 3)
+
+    resource_version = None
+    while waiting and time.time() < deadline:
+        if resource_version is None:
+            deployments = req('GET', url, headers)
+            for deployment in deployments['items']:
+                check(deployment)
+            resource_version = deployments['metadata']['resourceVersion']
+            continue
+
+        try:
+            for event in watch_events(url, headers, resource_version,
+                                      deadline - time.time()):
+                obj = event['object']
+                if event['type'] == 'ERROR':
+                    # Expired resourceVersion, list deployments again
+                    resource_version = None
+                    break
+                resource_version = obj['metadata']['resourceVersion']
+                if event['type'] in ['ADDED', 'MODIFIED']:
+                    check(obj)
+                if not waiting or time.time() > deadline:
+                    break
+        except requests.exceptions.RequestException:
+            # Watch dropped, resume from the last received event
+            time.sleep(min(1, max(0, deadline - time.time())))
+
+    return ready
+
+
+def teardown_result(func, done):
+    """
+    Run teardown request and describe its outcome, missing object
+    is not an error (output: str)
+    """
+    try:
+        func()
+    except HTTPError as e:
+        if e.status_code == 404:
+            return 'not found'
+        return 'failed: {}'.format(e.body)
+
+    return done
+
+
+def scale_down(k8s_host, **kwargs):
+    """
+    Scale down number of replicas to 0 concurrently (output: dict)
+    """
+    pass_headers = {}
+    if 'k8s_api_headers' in kwargs:
+        headers = kwargs.pop('k8s_api_headers')
+
+    pass_headers.update(headers)
+    pass_headers.update({
+        'Content-Type': 'application/strategic-merge-patch+json'
+    })
+    payload = {
+        'spec': {
+            'replicas': 0
+        }
+    }
+    parallelism = kwargs.get('parallelism', 1)
+    namespace = kwargs['namespace']
+    deployments = list(spec_objects(kwargs['objects'], 'deployments'))
+
+    def scale(deployment_name):
+        url = api_url(k8s_host, 'deployments', namespace, deployment_name)
+
+        return teardown_result(
+            lambda: req('PATCH', url, pass_headers, payload), 'scaled down'
+        )
+
+    return dict(zip(deployments, parallel_map(scale, deployments, parallelism)))
+
+
+def delete_object(k8s_host, **kwargs):
+    """
+    Delete deployment and service objects from Kubernetes concurrently,
+    replica sets and pods are removed by garbage collector along with
+    their deployment (output: dict)
+    """
+    pass_headers = {}
+    if 'k8s_api_headers' in kwargs:
+        headers = kwargs.pop('k8s_api_headers')
+
+    pass_headers.update(headers)
+
+    parallelism = kwargs.get('parallelism', 1)
+    namespace = kwargs['namespace']
+    objects = kwargs['objects']
+    # Deployment is gone only after all of its dependents are deleted
+    options = {
+        'kind': 'DeleteOptions',
+        'apiVersion': 'v1',
+        'propagationPolicy': 'Foreground'
+    }
+
+    names = [
+        (obj, name) for obj in ['deployments', 'services']
+        for name in spec_objects(objects, obj)
+    ]
+
+    def delete(item):
+        obj, obj_name = item
+        url = api_url(k8s_host, obj, namespace, obj_name)
+
+        return teardown_result(
+            lambda: req('DELETE', url, pass_headers, payload=options),
+            'deleted'
+        )
+
+    report = dict((obj, {}) for obj, _ in names)
+    for (obj, obj_name), result in zip(
+            names, parallel_map(delete, names, parallelism)):
+        report[obj][obj_name] = result
+
+    return report
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls with the same key into one, callers which
+    arrive while the call is in flight wait for it and share its result
+    (or error), results are shared and must not be modified
+    """
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, func):
+        """
+        Call function unless call with the same key is already in flight,
+        in that case wait for its result (output: any)
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = {
+                    'done': threading.Event(), 'result': None, 'error': None
+                }
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            flight['done'].wait()
+            e = flight['error']
+            if isinstance(e, HTTPError):
+                # Every caller gets its own error response
+                abort(e.status_code, e.body)
+            elif e is not None:
+                raise e
+
+            return flight['result']
+
+        try:
+            flight['result'] = func()
+        except BaseException as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+            flight['done'].set()
+
+        return flight['result']
+
+    def forget(self, keys):
+        """
+        Stop sharing calls in flight for the keys, so reads started after
+        a write never get value read before it
+        """
+        with self.lock:
+            for key in keys:
+                self.flights.pop(key, None)
+
+
+# Concurrent identical reads coalesced per backend
+FLIGHTS = {
+    'consul': SingleFlight(),
+    'kubernetes': SingleFlight()
+}
+
+
+class KVCache(object):
+    """
+    LRU cache of decoded Consul values under the watched prefix,
+    entries are tracked by ModifyIndex and evicted by background watcher
+    as soon as blocking query reports them as modified or deleted, values
+    under the immutable prefix (content blobs addressed by digest) are
+    not watched and stay cached until they are deleted or evicted
+    """
+    def __init__(self, consul_host, prefix, immutable=None, size=1024,
+                 wait=300):
+        self.consul_host = consul_host
+        self.prefix = prefix.rstrip('/') + '/'
+        self.immutable = immutable.rstrip('/') + '/' if immutable else None
+        self.size = size
+        self.wait = wait
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Bumped on every invalidation, values fetched before that are dropped
+        self.generation = 0
+        self.synced = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def covers(self, key):
+        return key.startswith(self.prefix) or self.is_immutable(key)
+
+    def is_immutable(self, key):
+        return self.immutable is not None and key.startswith(self.immutable)
+
+    def get(self, key):
+        """
+        Return cached value or None (output: dict)
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or not (self.synced or self.is_immutable(key)):
+                self.misses += 1
+                return None
+
+            self.entries[key] = entry
+            self.hits += 1
+
+            return entry[1]
+
+    def put(self, key, modify_index, value, generation):
+        """
+        Store value fetched while cache was at the given generation,
+        immutable values are stored regardless
+        """
+        with self.lock:
+            if not self.is_immutable(key) and (
+                    generation != self.generation or not self.synced):
+                return
+
+            self.entries.pop(key, None)
+            self.entries[key] = (modify_index, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys=None):
+        """
+        Drop specified keys or whole cache if keys are not provided
+        """
+        with self.lock:
+            self.generation += 1
+            if keys is None:
+                self.entries.clear()
+                return
+
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def sync(self, indexes):
+        """
+        Drop watched entries that are missing from or modified in
+        the dict of ModifyIndex values returned by blocking query
+        """
+        with self.lock:
+            self.generation += 1
+            for key, entry in list(self.entries.items()):
+                if (not self.is_immutable(key) and
+                        indexes.get(key) != entry[0]):
+                    del self.entries[key]
+            self.synced = True
+
+    def stats(self):
+        """
+        Cache statistics (output: dict)
+        """
+        with self.lock:
+            return {
+                'prefix': self.prefix,
+                'size': len(self.entries),
+                'max_size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'synced': self.synced
+            }
+
+    def watch(self):
+        """
+        Follow changes under the prefix with Consul blocking queries,
+        meant to be run in a daemon thread, only small pointers are stored
+        under the prefix (content blobs are kept apart), so they are all
+        fetched along with their ModifyIndex on every change
+        """
+        url = '{}/{}/{}'.format(self.consul_host, CONSUL_KV_API, self.prefix)
+        # Blocking query holds its connection, pooled sessions
+        # are left for regular requests
+        session = requests.Session()
+        index = 0
+
+        while True:
+            try:
+                r = session.get(
+                        url,
+                        params={
+                            'recurse': '',
+                            'index': index,
+                            'wait': '{}s'.format(self.wait)
+                        },
+                        timeout=self.wait + self.wait // 16 + 10
+                    )
+                if r.status_code not in [200, 404]:
+                    r.raise_for_status()
+
+                new_index = int(r.headers.get('X-Consul-Index', 0))
+                if new_index == index:
+                    continue
+                # Index can go backwards (e.g. after snapshot restore)
+                index = new_index if new_index > index else 0
+
+                entries = r.json() if r.status_code == 200 else []
+                self.sync(
+                    dict((e['Key'], e['ModifyIndex']) for e in entries)
+                )
+            except (requests.exceptions.RequestException, ValueError) as e:
+                # Nothing can be trusted until watch is re-established
+                with self.lock:
+                    self.synced = False
+                self.invalidate()
+                index = 0
+                print('Cache watch for {} failed, {}'.format(self.prefix, e))
+                time.sleep(5)
+
+    def start(self):
+        thread = threading.Thread(target=self.watch, name='kv-cache-watch')
+        thread.daemon = True
+        thread.start()
+
+
+def tail(data, offset):
+    """
+    Zero-copy view of data from offset to the end (output: buffer)
+    """
+    try:
+        # Python 2 zlib accepts only old-style buffers
+        return buffer(data, offset)
+    except NameError:
+        return memoryview(data)[offset:]
+
+
+def compact(key):
+    """
+    Whether value of the key is compressed and chunked (output: bool)
+    """
+    return STORAGE['prefix'] is not None and (
+        key.startswith(STORAGE['prefix']) or is_blob(key)
+    )
+
+
+def chunk_dir(key):
+    """
+    Consul prefix of chunks of the key, chunks of content blob are next
+    to chunks of specification revisions (output: str)
+    """
+    if is_blob(key):
+        spec, digest = key[len(STORAGE['blob_prefix']):].rsplit('/', 1)
+        return '{}{}/blobs/{}'.format(STORAGE['chunk_prefix'], spec, digest)
+
+    return STORAGE['chunk_prefix'] + key[len(STORAGE['prefix']):]
+
+
+def encode_value(key, value):
+    """
+    Serialize value as minified JSON, compressed if the key is in compact
+    storage and value is at least min_size long (output: bytes)
+    """
+    data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    if (compact(key) and STORAGE['compression'] == 'zlib' and
+            len(data) >= STORAGE['min_size']):
+        data = KV_ZLIB_MARKER + zlib.compress(data, STORAGE['level'])
+
+    return data
+
+
+def get_chunks(consul_host, manifest):
+    """
+    Retrieve chunks of the value with a single request and verify
+    their digest (output: bytes)
+    """
+    url = '{}/{}/{}/?recurse'.format(
+            consul_host, CONSUL_KV_API, manifest['prefix']
+        )
+
+    r = req('GET', url, status_code=True)
+    if r['status_code'] not in [200, 404]:
+        abort(r['status_code'], 'Unable to retrieve {} chunks'.format(
+            manifest['prefix']
+        ))
+
+    chunks = dict(
+        (entry['Key'].rsplit('/', 1)[1], entry['Value'] or '')
+        for entry in (r['payload'] if r['status_code'] == 200 else [])
+    )
+    data = b''.join(
+        b64decode(chunks.get(str(i), '')) for i in range(manifest['chunks'])
+    )
+    if sha256(data).hexdigest() != manifest['sha256']:
+        raise ValueError('Chunks of {} are incomplete or corrupted'.format(
+            manifest['prefix']
+        ))
+
+    return data
+
+
+def decode_raw(consul_host, data):
+    """
+    JSON bytes of value stored in any of the storage formats,
+    decompressed and reassembled from chunks (output: bytes)
+    """
+    if data.startswith(KV_CHUNKS_MARKER):
+        data = get_chunks(consul_host, json.loads(
+            data[len(KV_CHUNKS_MARKER):].decode('utf-8')
+        ))
+    if data.startswith(KV_ZLIB_MARKER):
+        data = zlib.decompress(tail(data, len(KV_ZLIB_MARKER)))
+
+    return data
+
+
+def decode_value(consul_host, data):
+    """
+    Decode value stored in any of the storage formats, pretty-printed
+    JSON written by previous versions included (output: dict)
+    """
+    return json.loads(decode_raw(consul_host, data))
+
+
+def get_raw(consul_host, key):
+    """
+    Retrieve JSON bytes of the value for specified key from Consul
+    without decoding them, along with its ModifyIndex (output: tuple)
+    """
+    url = '{}/{}/{}?raw'.format(consul_host, CONSUL_KV_API, key)
+
+    # Raw value is neither base64 encoded nor wrapped in JSON list,
+    # index of single key is its ModifyIndex
+    for attempt in range(2):
+        r = req('GET', url, raw=True)
+        try:
+            return (
+                decode_raw(consul_host, r.content),
+                int(r.headers.get('X-Consul-Index', 0))
+            )
+        except (ValueError, zlib.error) as e:
+            # Chunks could be replaced in the meantime, read it once again
+            if attempt or not r.content.startswith(KV_CHUNKS_MARKER):
+                abort(422, 'Bad JSON: {}'.format(e))
+
+
+def get_kv(consul_host, key):
+    """
+    Retrieve value for specified key from Consul,
+    values of cached keys are shared and must not be modified
+    (output: dict)
+    """
+    cache = KV_CACHES.get(consul_host)
+    if cache is not None and cache.covers(key):
+        generation = cache.generation
+        value = cache.get(key)
+        if value is not None:
+            return value
+    else:
+        cache = None
+
+    def fetch():
+        data, modify_index = get_raw(consul_host, key)
+        try:
+            value = json.loads(data)
+        except ValueError as e:
+            abort(422, 'Bad JSON: {}'.format(e))
+
+        if cache is not None:
+            cache.put(key, modify_index, value, generation)
+
+        return value
+
+    # Hot keys (e.g. latest specification) are read once
+    # for all concurrent requests
+    return FLIGHTS['consul'].do((consul_host, key), fetch)
+
+
+def get_kv_tree(consul_host, prefix):
+    """
+    Retrieve all values under specified prefix from Consul
+    (output: dict of decoded values keyed by Consul key)
+    """
+    url = '{}/{}/{}/?recurse'.format(consul_host, CONSUL_KV_API, prefix)
+
+    r = req('GET', url, status_code=True)
+    if r['status_code'] == 404:
+        return {}
+    elif r['status_code'] != 200:
+        abort(r['status_code'], 'Unable to retrieve {} tree'.format(prefix))
+
+    tree = {}
+    for entry in r['payload']:
+        try:
+            tree[entry['Key']] = decode_value(
+                consul_host, b64decode(entry['Value'] or '')
+            )
+        except (ValueError, zlib.error):
+            # Not written by k8s-deployer, always treated as changed
+            tree[entry['Key']] = None
+
+    return tree
+
+
+def invalidate_kv(consul_host, keys):
+    """
+    Drop written or deleted keys from the Consul K/V cache, reads
+    already in flight are not shared any more
+    """
+    FLIGHTS['consul'].forget([(consul_host, key) for key in keys])
+    cache = KV_CACHES.get(consul_host)
+    if cache is not None:
+        cache.invalidate(keys)
+
+
+def kv_op(verb, key, data=None):
+    """
+    Consul transaction operation on the key with optional raw value
+    (output: dict)
+    """
+    op = {
+        'KV': {
+            'Verb': verb,
+            'Key': key
+        }
+    }
+    if data is not None:
+        op['KV']['Value'] = b64encode(data).decode('ascii')
+
+    return op
+
+
+def kv_set_ops(key, value):
+    """
+    Consul transaction operations which set value of the key, values bigger
+    than chunk size are written as chunks followed by manifest (output: list)
+    """
+    data = encode_value(key, value)
+    if not compact(key):
+        return [kv_op('set', key, data)]
+
+    size = STORAGE['chunk_size']
+    if len(data) <= size:
+        # Chunks of the previous value if it was chunked
+        return [
+            kv_op('delete-tree', chunk_dir(key) + '/'),
+            kv_op('set', key, data)
+        ]
+
+    digest = sha256(data).hexdigest()
+    prefix = '{}/{}'.format(chunk_dir(key), digest[:16])
+    ops = [
+        kv_op('set', '{}/{}'.format(prefix, i // size), data[i:i + size])
+        for i in range(0, len(data), size)
+    ]
+    ops.append(kv_op('set', key, KV_CHUNKS_MARKER + json.dumps({
+        'prefix': prefix,
+        'chunks': len(ops),
+        'size': len(data),
+        'sha256': digest
+    }, separators=(',', ':')).encode('utf-8')))
+
+    return ops
+
+
+def kv_delete_op(key):
+    """
+    Consul transaction operation which deletes the key (output: dict)
+    """
+    return kv_op('delete', key)
+
+
+def split_txn(ops):
+    """
+    Split K/V operations in order into transactions of at most as many
+    (and as big) operations as Consul accepts at once (output: list)
+    """
+    chunks = []
+    size = 0
+    for op in ops:
+        op_size = len(op['KV'].get('Value') or '')
+        if (not chunks or len(chunks[-1]) >= CONSUL_TXN_MAX_OPS or
+                size + op_size > CONSUL_TXN_MAX_BYTES):
+            chunks.append([])
+            size = 0
+        chunks[-1].append(op)
+        size += op_size
+
+    return chunks
+
+
+def txn_kv(consul_host, ops):
+    """
+    Execute list of K/V operations through Consul transaction API,
+    operations are split in order into multiple transactions when there are
+    more of them (or bigger) than Consul accepts at once (output: list)
+    """
+    url = '{}/{}'.format(consul_host, CONSUL_TXN_API)
+
+    results = []
+    for chunk in split_txn(ops):
+        try:
+            payload = req('PUT', url, payload=chunk)
+        finally:
+            invalidate_kv(consul_host, [
+                op['KV']['Key'] for op in chunk
+                if op['KV']['Verb'] not in KV_READ_VERBS
+            ])
+        results.extend(payload.get('Results') or [])
+
+    return results
+
+
+def prune_chunks(consul_host, prefixes):
+    """
+    Delete chunks of replaced values, all but specified chunk
+    prefixes of the keys are removed
+    """
+    ops = []
+    for prefix in prefixes:
+        parent = prefix.rsplit('/', 1)[0] + '/'
+        url = '{}/{}/{}?keys&separator=/'.format(
+                consul_host, CONSUL_KV_API, parent
+            )
+        ops += [
+            kv_op('delete-tree', p) for p in req('GET', url)
+            if p != prefix + '/'
+        ]
+
+    txn_kv(consul_host, ops)
+
+
+def create_kv(consul_host, key, value=None):
+    """
+    Create key/value pair or multiple pairs (dict) on Consul
+    """
+    if type(key) is not dict:
+        key = {key: value}
+
+    ops = []
+    chunked = []
+    for k, v in key.items():
+        k_ops = kv_set_ops(k, v)
+        if k_ops[0]['KV']['Verb'] == 'set' and len(k_ops) > 1:
+            chunked.append(k_ops[0]['KV']['Key'].rsplit('/', 1)[0])
+        ops += k_ops
+
+    # Chunks are written before manifests and replaced ones are
+    # deleted afterwards, so readers always find complete value
+    txn_kv(consul_host, ops)
+    if chunked:
+        prune_chunks(consul_host, chunked)
+
+
+def delete_kv(consul_host, key):
+    """
+    Delete specified key or list of keys (along with their chunks)
+    from Consul
+    """
+    if type(key) is str:
+        key = [key]
+
+    ops = []
+    for k in key:
+        ops.append(kv_delete_op(k))
+        if compact(k):
+            ops.append(kv_op('delete-tree', chunk_dir(k) + '/'))
+
+    txn_kv(consul_host, ops)
+
+
+def get_index(consul_host, key):
+    """
+    Modify index of the key bypassing the cache, 0 if it does not exist
+    (output: int)
+    """
+    url = '{}/{}/{}'.format(consul_host, CONSUL_KV_API, key)
+
+    r = req('GET', url, status_code=True)
+    if r['status_code'] == 404:
+        return 0
+    elif r['status_code'] != 200:
+        abort(r['status_code'], 'Unable to retrieve {} key'.format(key))
+
+    return r['payload'][0]['ModifyIndex']
+
+
+def kv_check_op(key, index):
+    """
+    Consul transaction operation which fails the whole transaction if the
+    key was modified since the index (0 as it does not exist) (output: dict)
+    """
+    if not index:
+        return kv_op('check-not-exists', key)
+
+    op = kv_op('check-index', key)
+    op['KV']['Index'] = index
+
+    return op
+
+
+def get_entries(consul_host, keys):
+    """
+    Retrieve decoded values of the keys (None for content blobs) along
+    with their modify indexes straight from Consul in a transaction, keys
+    deleted in the meantime are left out (output: dict of tuples)
+    """
+    def get(key):
+        url = '{}/{}/{}'.format(consul_host, CONSUL_KV_API, key)
+        r = req('GET', url, status_code=True)
+        if r['status_code'] == 404:
+            return None
+        elif r['status_code'] != 200:
+            abort(r['status_code'], 'Unable to retrieve {} key'.format(key))
+
+        return {'KV': r['payload'][0]}
+
+    try:
+        results = txn_kv(consul_host, [kv_op('get', key) for key in keys])
+    except HTTPError as e:
+        if e.status_code != 409:
+            raise
+        # Missing key fails the whole transaction, read them one by one
+        results = [
+            r for r in parallel_map(get, keys, 10) if r is not None
+        ]
+
+    entries = {}
+    for r in results:
+        key = r['KV']['Key']
+        value = None
+        if not is_blob(key):
+            try:
+                value = decode_value(
+                    consul_host, b64decode(r['KV']['Value'] or '')
+                )
+            except (ValueError, zlib.error):
+                # Not written by k8s-deployer
+                pass
+        entries[key] = (value, r['KV']['ModifyIndex'])
+
+    return entries
+
+
+def list_kv(consul_host, prefix, separator=None):
+    """
+    List keys under specified prefix in lexicographic order, with separator
+    only up to the separator (shallow listing, "directories" end with it),
+    empty if there are none (output: list)
+    """
+    url = '{}/{}/{}/?keys'.format(consul_host, CONSUL_KV_API, prefix)
+    if separator is not None:
+        url += '&' + urlencode({'separator': separator})
+
+    r = req('GET', url, status_code=True)
+    if r['status_code'] == 404:
+        return []
+    elif r['status_code'] != 200:
+        abort(r['status_code'], 'Unable to list {} keys'.format(prefix))
+
+    return r['payload']
+
+
+def spec_digest(payload):
+    """
+    SHA-256 of canonical JSON serialization of specification (output: str)
+    """
+    return sha256(json.dumps(
+        payload, sort_keys=True, separators=(',', ':')
+    ).encode('utf-8')).hexdigest()
+
+
+def is_revision(key):
+    """
+    Whether the key is specification revision (output: bool)
+    """
+    return REVISION_ID.match(key.rsplit('/', 1)[-1]) is not None
+
+
+def is_blob(key):
+    """
+    Whether the key holds content of specification (output: bool)
+    """
+    return (STORAGE['blob_prefix'] is not None and
+            key.startswith(STORAGE['blob_prefix']))
+
+
+def blob_dir(spec_key):
+    """
+    Consul prefix of content blobs of specification, kept apart from
+    the specifications tree, so that only small pointers are watched
+    by the cache (output: str)
+    """
+    return STORAGE['blob_prefix'] + spec_key[len(STORAGE['prefix']):]
+
+
+def list_spec_kv(consul_host, spec_key):
+    """
+    List keys of specification along with its content blobs
+    at once (output: list)
+    """
+    return sum(parallel_map(
+        lambda prefix: list_kv(consul_host, prefix),
+        [spec_key, blob_dir(spec_key)], 2
+    ), [])
+
+
+def get_spec(consul_host, key):
+    """
+    Retrieve specification and value stored under the key, which is
+    either pointer to the content blob or (written by previous versions)
+    whole specification, values are shared and must not be modified
+    (output: tuple)
+    """
+    value = get_kv(consul_host, key)
+    if 'blob' not in value:
+        return value, value
+
+    payload = dict(get_kv(consul_host, value['blob']))
+    payload['id'] = value['id']
+
+    return payload, value
+
+
+def get_raw_spec(consul_host, key):
+    """
+    JSON bytes of specification stored under the key straight from its
+    content blob with revision ID filled in, None if it has to be decoded
+    (whole specification or blob written by previous versions)
+    (output: list of bytes)
+    """
+    pointer = get_kv(consul_host, key)
+    if 'blob' not in pointer:
+        return None
+
+    # Blobs are immutable, concurrent reads of the same one are shared
+    data = FLIGHTS['consul'].do(
+            (consul_host, pointer['blob'], 'raw'),
+            lambda: get_raw(consul_host, pointer['blob'])[0]
+        )
+    if not data.startswith(SPEC_BLOB_PREFIX):
+        return None
+
+    return [
+        b'{"id":', json.dumps(pointer['id']).encode('utf-8'), b',',
+        data[len(SPEC_BLOB_PREFIX):]
+    ]
+
+
+def spec_blob(payload):
+    """
+    Content blob of specification, ID is unset and first, so raw responses
+    can replace it (output: OrderedDict)
+    """
+    return OrderedDict(
+        [('id', None)] + [(k, v) for k, v in payload.items() if k != 'id']
+    )
+
+
+def store_pointers(consul_host, blob_key, blob, index, pointers):
+    """
+    Write pointers (dict) to the content blob in single transaction, only
+    if the blob is still stored under the modify index, otherwise (or with
+    no index) the blob is stored first (output: dict of modify indexes
+    keyed by written key)
+    """
+    ops = []
+    for key, value in pointers.items():
+        ops += kv_set_ops(key, value)
+
+    for attempt in range(3):
+        if index:
+            try:
+                results = txn_kv(
+                    consul_host, [kv_check_op(blob_key, index)] + ops
+                )
+                break
+            except HTTPError as e:
+                if e.status_code != 409:
+                    raise
+        # Deleted by cleanup in the meantime or not stored yet
+        blob_ops = kv_set_ops(blob_key, blob)
+        if len(split_txn(blob_ops + ops)) == 1:
+            results = txn_kv(consul_host, blob_ops + ops)
+            break
+        index = dict(
+            (r['KV']['Key'], r['KV']['ModifyIndex'])
+            for r in txn_kv(consul_host, blob_ops)
+        )[blob_key]
+    else:
+        abort(409, 'Content blob {} keeps being cleaned up concurrently, '
+                   'try again'.format(blob_key))
+
+    return dict((r['KV']['Key'], r['KV']['ModifyIndex']) for r in results)
+
+
+def rotate_specs(consul_host, spec_key, retention, names, keys=None,
+                 entries=None):
+    """
+    Delete revisions of specification beyond retention along with
+    content blobs which are no longer referenced by remaining revisions
+    or pointers (names, e.g. latest and deployed), full listing and entries
+    (see get_entries) already retrieved by caller are reused, nothing is
+    deleted if any pointer was changed in the meantime
+    """
+    if keys is None:
+        keys = list_spec_kv(consul_host, spec_key)
+    children = [
+        k for k in keys
+        if k.startswith(spec_key + '/') and '/' not in k[len(spec_key) + 1:]
+    ]
+    revs = [k for k in children if is_revision(k)]
+    stale = revs[:-retention]
+    # Latest and deployed (per cluster, including not yet deployed) pointers
+    pointers = sorted(set(
+        ['{}/{}'.format(spec_key, name) for name in names] +
+        [k for k in children if not is_revision(k)]
+    ))
+
+    entries = dict(entries or {})
+    entries.update(get_entries(consul_host, [
+        k for k in revs[len(stale):] + pointers
+        if k in keys and k not in entries
+    ]))
+
+    referenced = set(
+        (entries[k][0] or {}).get('blob')
+        for k in revs[len(stale):] + pointers if k in entries
+    )
+    blobs = [
+        k for k in keys
+        if k.startswith(blob_dir(spec_key) + '/') and k not in referenced
+    ]
+
+    # Pointer written in the meantime could reference any of the blobs
+    ops = [kv_check_op(k, entries.get(k, (None, 0))[1]) for k in pointers]
+    checks = len(ops)
+    for key in stale + blobs:
+        # Single transaction, rest is left to the next rotation
+        if len(ops) + 2 > CONSUL_TXN_MAX_OPS:
+            break
+        ops.append(kv_delete_op(key))
+        if compact(key):
+            ops.append(kv_op('delete-tree', chunk_dir(key) + '/'))
+
+    if len(ops) > checks:
+        try:
+            txn_kv(consul_host, ops)
+        except HTTPError as e:
+            if e.status_code != 409:
+                raise
+
+
+def sync_svcs_kv(consul_host, key_path, svcs, namespace=None, prune=False):
+    """
+    Write service definitions that differ from the ones stored in Consul
+    deployments tree of the namespace (or whole tree), with prune
+    also delete definitions of services missing from the list (output: dict)
+    """
+    svc_key = '{}/deployments'.format(key_path)
+    if namespace is not None:
+        svc_key += '/{}'.format(namespace)
+
+    current = get_kv_tree(consul_host, svc_key)
+
+    kvs = {}
+    unchanged = []
+    for svc in svcs:
+        key = '{}/deployments/{}/{}'.format(
+                    key_path,
+                    svc['metadata']['namespace'],
+                    svc['metadata']['name']
+                )
+        if current.pop(key, None) == svc:
+            unchanged.append(key)
+        else:
+            kvs[key] = svc
+
+    create_kv(consul_host, kvs)
+    deleted = []
+    if prune:
+        deleted = sorted(current)
+        delete_kv(consul_host, deleted)
+
+    return {
+        'updated': sorted(kvs),
+        'unchanged': sorted(unchanged),
+        'deleted': deleted
+    }
+
+
+def catalog_svc(svc):
+    """
+    Consul agent service definition of NodePort service, name, tags and port
+    are derived the same way as in consul-template/k8s-svcgen.py (output: dict)
+    """
+    namespace = svc['metadata']['namespace']
+    name = svc['metadata']['name']
+    annotations = svc['metadata'].get('annotations') or {}
+
+    tags = []
+    for k, v in annotations.items():
+        constraint = k.split('.')[0]
+        if constraint == 'traefik':
+            tags.append('{}={}'.format(k, v))
+        elif constraint == 'tags':
+            tags += [ tag.strip() for tag in v.split(',') ]
+
+    meta = dict(CONSUL_AGENT_META)
+    meta['k8s-namespace'] = namespace
+
+    return {
+        'ID': catalog_svc_id(namespace, name),
+        'Name': name,
+        'Tags': sorted(tags),
+        'Port': svc['spec']['ports'][0]['nodePort'],
+        'Meta': meta
+    }
+
+
+def catalog_svc_id(namespace, name):
+    return 'k8s-{}-{}'.format(namespace, name)
+
+
+class CatalogSync(object):
+    """
+    Register NodePort services directly on Consul agents through the agent
+    service API, every agent is compared with the wanted state and only
+    services whose definition differs are (de)registered
+    """
+    def __init__(self, agents, parallelism=10):
+        self.agents = agents
+        self.parallelism = parallelism
+
+    def registered(self, agent):
+        """
+        Services registered by k8s-deployer on the agent (output: dict)
+        """
+        url = '{}/{}/services'.format(agent, CONSUL_AGENT_API)
+
+        return dict(
+            (svc_id, svc) for svc_id, svc in req('GET', url).items()
+            if all(
+                (svc.get('Meta') or {}).get(k) == v
+                for k, v in CONSUL_AGENT_META.items()
+            )
+        )
+
+    def sync_agent(self, agent, svcs, prune=False, namespace=None):
+        """
+        Apply services diff to a single agent (output: dict)
+        """
+        current = self.registered(agent)
+
+        register = []
+        deregister = []
+        for (ns, name), svc in sorted(svcs.items()):
+            svc_id = catalog_svc_id(ns, name)
+            have = current.pop(svc_id, None)
+            if svc is None or not is_nodeport(svc):
+                if have is not None:
+                    deregister.append(svc_id)
+                continue
+
+            want = catalog_svc(svc)
+            if have is None or [
+                        have.get('Service'), sorted(have.get('Tags') or []),
+                        have.get('Port'), have.get('Meta')
+                    ] != [want['Name'], want['Tags'], want['Port'], want['Meta']]:
+                register.append(want)
+
+        if prune:
+            deregister += sorted(
+                svc_id for svc_id, svc in current.items()
+                if namespace is None or
+                svc['Meta'].get('k8s-namespace') == namespace
+            )
+
+        for svc in register:
+            req('PUT', '{}/{}/service/register'.format(
+                agent, CONSUL_AGENT_API
+            ), payload=svc)
+        for svc_id in deregister:
+            req('PUT', '{}/{}/service/deregister/{}'.format(
+                agent, CONSUL_AGENT_API, svc_id
+            ))
+
+        return {
+            'registered': [svc['ID'] for svc in register],
+            'deregistered': deregister
+        }
+
+    def apply(self, svcs, prune=False, namespace=None):
+        """
+        Register services on all agents, svcs is a dict of service
+        definitions keyed by (namespace, name), None value deregisters
+        service, with prune also deregister all other services of the
+        namespace (or whole cluster) registered by k8s-deployer,
+        failure of one agent doesn't stop the others (output: list)
+        """
+        def sync(agent):
+            try:
+                result = self.sync_agent(agent, svcs, prune, namespace)
+            except HTTPError as e:
+                print('Catalog sync of {} failed, {}'.format(agent, e.body))
+                result = {'error': e.body}
+            result['agent'] = agent
 
-    if specs['kind'] == 'List':
-        deployments = specs['items']
-    else:
-        deployments = [specs]
-
-    for deployment in deployments:
-        deployment_name = deployment['metadata']['name']
-        url = '{}/{}/namespaces/{}/deployments/{}'.format(
-                    k8s_host, api_path,
-                    namespace,
-                    deployment_name
-                )
+            return result
 
-        req('PATCH', url, pass_headers, payload)
+        return parallel_map(sync, self.agents, self.parallelism)
 
 
-def delete_object(k8s_host, **kwargs):
+class SvcReconciler(object):
     """
-    Delete deployment and service objects from Kubernetes
+    Keep Consul deployments tree in sync with Kubernetes services by
+    following the watch API, events are coalesced per service and applied
+    in batches, last applied resourceVersion is persisted on Consul
+    under <key_path>/reconciler/services so watch resumes after restart
     """
-    pass_headers = {}
-    if 'k8s_api_headers' in kwargs:
-        headers = kwargs.pop('k8s_api_headers')
+    def __init__(self, k8s_host, k8s_api_headers, consul_host, key_path,
+                 debounce=1.0, timeout=300, catalog=None):
+        self.k8s_host = k8s_host
+        self.k8s_api_headers = k8s_api_headers
+        self.consul_host = consul_host
+        self.key_path = key_path
+        self.state_key = '{}/reconciler/services'.format(key_path)
+        self.debounce = debounce
+        self.timeout = timeout
+        self.catalog = catalog
+        self.pending = {}
+        self.resource_version = None
+        self.applied_version = None
+        self.lock = threading.Lock()
+        # Serializes batches and relists written to Consul
+        self.apply_lock = threading.Lock()
+
+    def svc_key(self, svc):
+        return '{}/deployments/{}/{}'.format(
+                    self.key_path,
+                    svc['metadata']['namespace'],
+                    svc['metadata']['name']
+                )
 
-    pass_headers.update(headers)
+    def load_version(self):
+        """
+        Retrieve last applied resourceVersion from Consul (output: str)
+        """
+        url = '{}/{}/{}'.format(self.consul_host, CONSUL_KV_API, self.state_key)
 
-    namespace = kwargs['namespace']
-    objects = kwargs['objects']
+        r = req('GET', url, status_code=True)
+        if r['status_code'] != 200:
+            return None
 
-    obj_names = []
-    for obj in objects:
-        if objects[obj]['specification']['kind'] == 'List':
-            specs = objects[obj]['specification']['items']
-        else:
-            specs = [objects[obj]['specification']]
+        return json.loads(b64decode(r['payload'][0]['Value']))['resourceVersion']
 
-        for spec in specs:
-            if obj == 'deployments':
-                rs_label_selector = spec['spec']['selector']['matchLabels']
-                labels = ','.join(
-                        [ '{}={}'.format(k, v)  for k, v in rs_label_selector.items() ]
-                    )
-                url = '{}/{}/namespaces/{}/{}/?labelSelector={}'.format(
-                        k8s_host, K8S_API['replicasets'],
-                        namespace, 'replicasets',
-                        labels
-                    )
-                obj_names.append({
-                    'deployments': spec['metadata']['name'],
-                    'replicasets': req('GET', url)['items'][0]['metadata']['name']
-                })
-            else:
-                obj_names.append({
-                    'services': spec['metadata']['name'],
-                })
-
-    for d in obj_names:
-        for obj, obj_name in d.items():
-            url = '{}/{}/namespaces/{}/{}/{}'.format(
-                        k8s_host, K8S_API[obj],
-                        namespace, obj, obj_name
+    def relist(self):
+        """
+        Full resync of deployments tree (output: str)
+        """
+        url = api_url(self.k8s_host, 'services')
+        svcs = req('GET', url, self.k8s_api_headers)
+
+        nodeports = []
+        for svc in svcs['items']:
+            if is_nodeport(svc):
+                svc.setdefault('kind', 'Service')
+                svc.setdefault('apiVersion', 'v1')
+                nodeports.append(svc)
+
+        resource_version = svcs['metadata']['resourceVersion']
+        with self.apply_lock:
+            with self.lock:
+                self.pending.clear()
+                self.resource_version = resource_version
+
+            sync_svcs_kv(
+                self.consul_host, self.key_path, nodeports, prune=True
+            )
+            if self.catalog is not None:
+                self.catalog.apply(dict(
+                    ((svc['metadata']['namespace'], svc['metadata']['name']),
+                     svc)
+                    for svc in nodeports
+                ), prune=True)
+            create_kv(self.consul_host, self.state_key, {
+                'resourceVersion': resource_version
+            })
+            self.applied_version = resource_version
+
+        return resource_version
+
+    def watch(self, resource_version):
+        """
+        Follow service events until watch expires, returns resourceVersion
+        to continue from or None if full relist is required (output: str)
+        """
+        url = api_url(self.k8s_host, 'services')
+
+        for event in watch_events(url, self.k8s_api_headers,
+                                  resource_version, self.timeout):
+            obj = event['object']
+            if event['type'] == 'ERROR':
+                # 410 Gone, requested resourceVersion is too old
+                if obj.get('code') == 410:
+                    return None
+                raise ValueError(obj.get('message', 'watch error'))
+
+            with self.lock:
+                if event['type'] in ['ADDED', 'MODIFIED']:
+                    obj.setdefault('kind', 'Service')
+                    obj.setdefault('apiVersion', 'v1')
+                    self.pending[self.svc_key(obj)] = (
+                        obj if is_nodeport(obj) else None
                     )
+                elif event['type'] == 'DELETED':
+                    self.pending[self.svc_key(obj)] = None
+                resource_version = obj['metadata']['resourceVersion']
+                self.resource_version = resource_version
 
-            req('DELETE', url, pass_headers)
+        return resource_version
 
-
-def get_kv(consul_host, key, list_keys=False):
+    def flush(self):
+        """
+        Apply coalesced events along with their resourceVersion
+        in a single Consul transaction
+        """
+        with self.apply_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                resource_version = self.resource_version
+
+            if resource_version in [None, self.applied_version]:
+                return
+
+            ops = []
+            for key, svc in sorted(pending.items()):
+                if svc is not None:
+                    ops += kv_set_ops(key, svc)
+                else:
+                    ops.append(kv_delete_op(key))
+            ops += kv_set_ops(self.state_key, {
+                'resourceVersion': resource_version
+            })
+            try:
+                txn_kv(self.consul_host, ops)
+            except HTTPError:
+                # Put back events which are not superseded by newer ones
+                with self.lock:
+                    for key, svc in pending.items():
+                        self.pending.setdefault(key, svc)
+                raise
+
+            if self.catalog is not None:
+                self.catalog.apply(dict(
+                    (tuple(key.rsplit('/', 2)[1:]), svc)
+                    for key, svc in pending.items()
+                ))
+            self.applied_version = resource_version
+
+    def run_flusher(self):
+        while True:
+            time.sleep(self.debounce)
+            try:
+                self.flush()
+            except HTTPError as e:
+                print('Reconciler flush failed, {}'.format(e.body))
+
+    def run_watcher(self):
+        resource_version = None
+        while True:
+            try:
+                if resource_version is None:
+                    resource_version = self.load_version()
+                    self.applied_version = resource_version
+                if resource_version is None:
+                    resource_version = self.relist()
+                resource_version = self.watch(resource_version)
+                if resource_version is None:
+                    # Expired resourceVersion, drop it and start over
+                    resource_version = self.relist()
+            except (requests.exceptions.RequestException, ValueError,
+                    HTTPError) as e:
+                print('Reconciler watch failed, {}'.format(
+                    getattr(e, 'body', e)
+                ))
+                # Resume from the last event received before failure
+                with self.lock:
+                    resource_version = self.resource_version or resource_version
+                time.sleep(5)
+
+    def start(self):
+        for target in [self.run_watcher, self.run_flusher]:
+            thread = threading.Thread(target=target, name='svc-reconciler')
+            thread.daemon = True
+            thread.start()
+
+
+class JobQueue(object):
     """
-    Retrieve value for specified key from Consul (output: dict or list)
+    Bounded executor for background jobs, state of every job is persisted
+    on Consul under <key_path>/jobs/<job_id> so it survives restarts
     """
-    url = '{}/{}/{}'.format(consul_host, CONSUL_KV_API, key)
+    def __init__(self, consul_host, key_path, workers=2, queue_size=100,
+                 retention=100):
+        self.consul_host = consul_host
+        self.job_key = '{}/jobs'.format(key_path)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.retention = retention
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.handlers = {}
+        self.active = set()
+        self.lock = threading.Lock()
+
+    def register(self, job_type, func):
+        """
+        Register function which executes jobs of the specified type
+        """
+        self.handlers[job_type] = func
 
-    if list_keys:
-        value = req('GET', url + '/?keys')
-    else:
+    def save(self, job):
+        create_kv(self.consul_host, '{}/{}'.format(self.job_key, job['id']), job)
+
+    def get(self, job_id):
+        """
+        Retrieve job state from Consul (output: dict)
+        """
+        return get_kv(self.consul_host, '{}/{}'.format(self.job_key, job_id))
+
+    def reserve(self, job_id):
+        """
+        Take a slot in the queue or reject the job if queue is full
+        """
+        with self.lock:
+            if len(self.active) >= self.queue_size + self.workers:
+                abort(503, 'Job queue is full, try again later')
+            self.active.add(job_id)
+
+    def submit(self, job_type, params):
+        """
+        Persist new job and schedule its execution (output: dict)
+        """
+        job = {
+            'id': '{:.0f}_{}'.format(time.time() * 10**6, uuid4()),
+            'type': job_type,
+            'params': params,
+            'state': 'queued',
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+            'result': None,
+            'error': None
+        }
+
+        self.reserve(job['id'])
         try:
-            value = json.loads(b64decode(req('GET', url)[0]['Value']))
-        except ValueError as e:
-            abort(422, 'Bad JSON: {}'.format(e))
+            self.save(job)
+        except HTTPError:
+            with self.lock:
+                self.active.discard(job['id'])
+            raise
+        queued = dict(job)
+        self.executor.submit(self.run, job)
+
+        return queued
+
+    def run(self, job):
+        """
+        Execute job and record its outcome
+        """
+        try:
+            job.update(state='running', started=time.time())
+            self.save(job)
+
+            try:
+                job['result'] = self.handlers[job['type']](**job['params'])
+                job['state'] = 'succeeded'
+            except HTTPError as e:
+                job['state'] = 'failed'
+                job['error'] = {'status': e.status_code, 'message': e.body}
+            except Exception as e:
+                job['state'] = 'failed'
+                job['error'] = {'status': 500, 'message': str(e)}
+
+            job['finished'] = time.time()
+            self.save(job)
+        except HTTPError as e:
+            print('Unable to save state of job {}, {}'.format(job['id'], e.body))
+        finally:
+            with self.lock:
+                self.active.discard(job['id'])
+
+        self.cleanup()
+
+    def job_ids(self):
+        """
+        List IDs of all persisted jobs, oldest first (output: list)
+        """
+        url = '{}/{}/{}/?keys'.format(
+                self.consul_host, CONSUL_KV_API, self.job_key
+            )
+        r = req('GET', url, status_code=True)
+        if r['status_code'] != 200:
+            return []
 
-    return value
+        return sorted(k.rsplit('/', 1)[1] for k in r['payload'])
 
+    def cleanup(self):
+        """
+        Delete finished jobs per retention value
+        """
+        with self.lock:
+            active = set(self.active)
 
-def create_kv(consul_host, key, value):
+        try:
+            stale = [
+                '{}/{}'.format(self.job_key, job_id)
+                for job_id in self.job_ids()[:-self.retention]
+                if job_id not in active
+            ]
+            delete_kv(self.consul_host, stale)
+        except HTTPError as e:
+            print('Unable to cleanup jobs, {}'.format(e.body))
+
+    def recover(self):
+        """
+        Reschedule jobs that were queued before restart and
+        mark as failed those that were interrupted while running
+        """
+        try:
+            for job_id in self.job_ids():
+                job = self.get(job_id)
+                if job['state'] == 'queued':
+                    self.reserve(job_id)
+                    self.executor.submit(self.run, job)
+                elif job['state'] == 'running':
+                    job.update(state='failed', finished=time.time(), error={
+                        'status': 500,
+                        'message': 'Job was interrupted by restart'
+                    })
+                    self.save(job)
+        except HTTPError as e:
+            print('Unable to recover jobs, {}'.format(e.body))
+
+
+def metrics_plugin(callback):
     """
-    Create key/value pair on Consul
+    Bottle plugin which records latency of every served request
     """
-    url = '{}/{}/{}'.format(consul_host, CONSUL_KV_API, key)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        status = 500
+        try:
+            body = callback(*args, **kwargs)
+            status = response.status_code
+            return body
+        except HTTPError as e:
+            status = e.status_code
+            raise
+        finally:
+            METRICS.observe(
+                'k8s_deployer_http_request_duration_seconds',
+                (
+                    ('route', request.route.rule),
+                    ('method', request.method),
+                    ('code', status)
+                ),
+                time.time() - start
+            )
 
-    req('PUT', url, payload=value)
+    return wrapper
 
 
-def delete_kv(consul_host, key):
+def pool_stats():
     """
-    Delete specified key or list of keys from Consul
+    Connection pools of every backend session (output: list of tuples)
     """
-    if type(key) is str:
-        key = [key]
+    stats = []
+    for session in SESSIONS.values():
+        pools = session.get_adapter('http://').poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats.append((
+                (('backend', session.backend),),
+                pool.pool.maxsize,
+                pool.pool.maxsize - pool.pool.qsize(),
+                pool.num_connections
+            ))
 
-    for k in key:
-        url = '{}/{}/{}'.format(consul_host, CONSUL_KV_API, k)
-        req('DELETE', url)
+    return stats
 
 
 def main():
@@ -379,6 +2798,24 @@ def main():
         action='store'
     )
 
+    parser.add_argument(
+        '-s', '--server',
+        help='Web server, paste threadpool or gevent event loop',
+        default='paste',
+        choices=['paste', 'gevent'],
+        dest='server',
+        action='store'
+    )
+
+    parser.add_argument(
+        '-c', '--connections',
+        help='Max number of concurrent connections (gevent server only)',
+        default=1000,
+        type=int,
+        dest='connections',
+        action='store'
+    )
+
     args = parser.parse_args()
 
     bind_addr = args.bind_addr
@@ -404,6 +2841,22 @@ def main():
         for h in os.environ.get('K8S_DEPLOYER_KUBE_API_HEADERS').split(','):
             for k, v in [h.strip().split('__')]:
                 config['kubernetes']['api']['headers'][k] = v
+    if os.environ.get('K8S_DEPLOYER_KUBE_PARALLELISM'):
+        config['kubernetes']['parallelism'] = int(
+            os.environ['K8S_DEPLOYER_KUBE_PARALLELISM']
+        )
+    if os.environ.get('K8S_DEPLOYER_KUBE_POOL_SIZE'):
+        config['kubernetes'].setdefault('pool', {})['size'] = int(
+            os.environ['K8S_DEPLOYER_KUBE_POOL_SIZE']
+        )
+    if os.environ.get('K8S_DEPLOYER_KUBE_POOL_KEEP_ALIVE'):
+        config['kubernetes'].setdefault('pool', {})['keep_alive'] = (
+            os.environ['K8S_DEPLOYER_KUBE_POOL_KEEP_ALIVE'].lower() == 'true'
+        )
+    if os.environ.get('K8S_DEPLOYER_KUBE_POOL_RETRIES'):
+        config['kubernetes'].setdefault('pool', {})['max_retries'] = int(
+            os.environ['K8S_DEPLOYER_KUBE_POOL_RETRIES']
+        )
 
     # Consul related env vars
     if os.environ.get('K8S_DEPLOYER_CONSUL_SCHEME'):
@@ -426,13 +2879,80 @@ def main():
         config['consul']['specifications']['retention'] = (
             os.environ['K8S_DEPLOYER_CONSUL_SPECS_RETENT']
         )
+    if os.environ.get('K8S_DEPLOYER_CONSUL_CACHE_SIZE'):
+        config['consul'].setdefault('cache', {})['size'] = int(
+            os.environ['K8S_DEPLOYER_CONSUL_CACHE_SIZE']
+        )
+    if os.environ.get('K8S_DEPLOYER_CONSUL_POOL_SIZE'):
+        config['consul'].setdefault('pool', {})['size'] = int(
+            os.environ['K8S_DEPLOYER_CONSUL_POOL_SIZE']
+        )
+    if os.environ.get('K8S_DEPLOYER_CONSUL_POOL_KEEP_ALIVE'):
+        config['consul'].setdefault('pool', {})['keep_alive'] = (
+            os.environ['K8S_DEPLOYER_CONSUL_POOL_KEEP_ALIVE'].lower() == 'true'
+        )
+    if os.environ.get('K8S_DEPLOYER_CONSUL_POOL_RETRIES'):
+        config['consul'].setdefault('pool', {})['max_retries'] = int(
+            os.environ['K8S_DEPLOYER_CONSUL_POOL_RETRIES']
+        )
+
+    if os.environ.get('K8S_DEPLOYER_CONSUL_CATALOG'):
+        config['consul'].setdefault('catalog', {})['enabled'] = (
+            os.environ['K8S_DEPLOYER_CONSUL_CATALOG'].lower() == 'true'
+        )
+    if os.environ.get('K8S_DEPLOYER_CONSUL_CATALOG_AGENTS'):
+        # K8S_DEPLOYER_CONSUL_CATALOG_AGENTS="http://node1:8500,http://node2:8500"
+        config['consul'].setdefault('catalog', {})['agents'] = [
+            agent.strip() for agent in
+            os.environ['K8S_DEPLOYER_CONSUL_CATALOG_AGENTS'].split(',')
+        ]
+
+    if os.environ.get('K8S_DEPLOYER_CONSUL_STORAGE_COMPRESSION'):
+        config['consul'].setdefault('storage', {})['compression'] = (
+            os.environ['K8S_DEPLOYER_CONSUL_STORAGE_COMPRESSION']
+        )
+
+    if os.environ.get('K8S_DEPLOYER_KUBE_RECONCILER'):
+        config['kubernetes'].setdefault('reconciler', {})['enabled'] = (
+            os.environ['K8S_DEPLOYER_KUBE_RECONCILER'].lower() == 'true'
+        )
+    if os.environ.get('K8S_DEPLOYER_KUBE_DISCOVERY_CACHE'):
+        config['kubernetes'].setdefault('discovery', {})['cache_file'] = (
+            os.environ['K8S_DEPLOYER_KUBE_DISCOVERY_CACHE']
+        )
+    if os.environ.get('K8S_DEPLOYER_KUBE_CLUSTERS'):
+        # K8S_DEPLOYER_KUBE_CLUSTERS="eu__https://k8s-eu:6443,us__https://k8s-us:6443"
+        config['kubernetes']['clusters'] = []
+        for c in os.environ.get('K8S_DEPLOYER_KUBE_CLUSTERS').split(','):
+            name, url = c.split('__')
+            url = urlparse(url)
+            config['kubernetes']['clusters'].append({
+                'name': name,
+                'scheme': url.scheme,
+                'host': url.hostname,
+                'port': url.port
+            })
+
+    # Jobs related env vars
+    if os.environ.get('K8S_DEPLOYER_JOBS_WORKERS'):
+        config.setdefault('jobs', {})['workers'] = int(
+            os.environ['K8S_DEPLOYER_JOBS_WORKERS']
+        )
+    if os.environ.get('K8S_DEPLOYER_JOBS_QUEUE_SIZE'):
+        config.setdefault('jobs', {})['queue_size'] = int(
+            os.environ['K8S_DEPLOYER_JOBS_QUEUE_SIZE']
+        )
 
-    k8s_host = '{}://{}:{}'.format(
-            config['kubernetes']['scheme'],
-            config['kubernetes']['host'],
-            config['kubernetes']['port']
+    # Batch related env vars
+    if os.environ.get('K8S_DEPLOYER_BATCH_PARALLELISM'):
+        config.setdefault('batch', {})['parallelism'] = int(
+            os.environ['K8S_DEPLOYER_BATCH_PARALLELISM']
         )
-    k8s_api_headers = config['kubernetes']['api']['headers']
+    if os.environ.get('K8S_DEPLOYER_BATCH_NAMESPACE_PARALLELISM'):
+        config.setdefault('batch', {})['namespace_parallelism'] = int(
+            os.environ['K8S_DEPLOYER_BATCH_NAMESPACE_PARALLELISM']
+        )
+
     consul_host = '{}://{}:{}'.format(
             config['consul']['scheme'],
             config['consul']['host'],
@@ -441,6 +2961,425 @@ def main():
     consul_key_path = config['consul']['key_path']
     spec_retention = config['consul']['specifications']['retention']
 
+    # One keep-alive connection pool per backend, shared by all workers
+    # (or by all concurrent connections in gevent server mode)
+    if args.server == 'gevent':
+        pool_size = args.connections
+    else:
+        pool_size = workers
+    pool = config['consul'].get('pool', {})
+    create_session(
+        consul_host,
+        pool_size=pool.get('size', pool_size),
+        keep_alive=pool.get('keep_alive', True),
+        max_retries=pool.get('max_retries', 3),
+        backoff_factor=pool.get('backoff_factor', 0.2),
+        backend='consul'
+    )
+
+    # Kubernetes clusters, settings missing from the cluster are taken
+    # from the kubernetes block, the first (primary) cluster keeps Consul
+    # deployments tree and deployed specification on their usual paths
+    clusters = OrderedDict()
+    for c in config['kubernetes'].get('clusters') or [{'name': 'default'}]:
+        conf = dict(config['kubernetes'], **c)
+        if not clusters:
+            key_path, deployed = consul_key_path, 'deployed'
+            backend = 'kubernetes'
+        else:
+            key_path = '{}/clusters/{}'.format(consul_key_path, c['name'])
+            deployed = 'deployed-{}'.format(c['name'])
+            backend = 'kubernetes-{}'.format(c['name'])
+        clusters[c['name']] = {
+            'name': c['name'],
+            'k8s_host': '{}://{}:{}'.format(
+                conf['scheme'], conf['host'], conf['port']
+            ),
+            'k8s_api_headers': conf['api']['headers'],
+            'parallelism': conf.get('parallelism', 1),
+            'pool': conf.get('pool', {}),
+            'discovery': dict(conf.get('discovery', {})),
+            'key_path': key_path,
+            'deployed': deployed,
+            'backend': backend
+        }
+        if len(clusters) > 1 and 'discovery' not in c and \
+                clusters[c['name']]['discovery'].get('cache_file'):
+            clusters[c['name']]['discovery']['cache_file'] += '.{}'.format(
+                c['name']
+            )
+    # Parallelism below one never lets the batch scheduler start anything
+    limits = [
+        ('{} cluster parallelism'.format(c['name']), c['parallelism'])
+        for c in clusters.values()
+    ] + [
+        ('batch {}'.format(k), config['batch'][k])
+        for k in ['parallelism', 'namespace_parallelism']
+        if config.get('batch', {}).get(k) is not None
+    ]
+    for name, value in limits:
+        if not isinstance(value, int) or value < 1:
+            print('Invalid {} {}, must be an integer of at least 1'.format(
+                name, value
+            ))
+            sys.exit(3)
+
+    primary = list(clusters.values())[0]
+    # Pointers to specification content, checked by cleanup
+    spec_pointers = ['latest'] + [c['deployed'] for c in clusters.values()]
+
+    # Every cluster has its own connection pool and API discovery,
+    # API paths of Kubernetes objects are resolved from discovery made
+    # once at startup (or loaded from the cache file) and refreshed
+    # in background, built-in API paths are used if it fails
+    for cluster in clusters.values():
+        k8s_host = cluster['k8s_host']
+        pool = cluster['pool']
+        if k8s_host not in SESSIONS:
+            create_session(
+                k8s_host,
+                pool_size=pool.get('size', pool_size),
+                keep_alive=pool.get('keep_alive', True),
+                max_retries=pool.get('max_retries', 3),
+                backoff_factor=pool.get('backoff_factor', 0.2),
+                backend=cluster['backend']
+            )
+        K8S_APIS[k8s_host] = ApiDiscovery(
+            k8s_host,
+            cluster['k8s_api_headers'],
+            ttl=cluster['discovery'].get('ttl', 3600),
+            cache_file=cluster['discovery'].get('cache_file')
+        )
+    parallel_map(
+        lambda discovery: discovery.start(),
+        list(K8S_APIS.values()), len(K8S_APIS)
+    )
+
+    # Specifications are stored minified, optionally compressed
+    # and split into chunks under a separate tree when too big
+    storage = config['consul'].get('storage', {})
+    compression = storage.get('compression')
+    if compression not in [None, 'none', 'zlib']:
+        print('Unsupported storage compression {}'.format(compression))
+        sys.exit(3)
+    STORAGE.update({
+        'prefix': '{}/specifications/'.format(consul_key_path),
+        'blob_prefix': '{}/blobs/'.format(consul_key_path),
+        'chunk_prefix': '{}/chunks/'.format(consul_key_path),
+        'compression': None if compression == 'none' else compression,
+        'level': storage.get('level', 6),
+        'min_size': storage.get('min_size', 1024),
+        'chunk_size': storage.get('chunk_size', 262144)
+    })
+
+    # Specifications cache, disabled when size is set to 0
+    cache = config['consul'].get('cache', {})
+    if cache.get('size', 1024) > 0:
+        KV_CACHES[consul_host] = KVCache(
+            consul_host,
+            '{}/specifications'.format(consul_key_path),
+            immutable='{}/blobs'.format(consul_key_path),
+            size=cache.get('size', 1024),
+            wait=cache.get('wait', 300)
+        )
+        KV_CACHES[consul_host].start()
+
+    # Services registered directly on Consul agents, when enabled
+    # consul-template with k8s-svcgen.py is no longer needed
+    catalog = None
+    catalog_config = config['consul'].get('catalog', {})
+    if catalog_config.get('enabled', False):
+        agents = catalog_config.get('agents') or [consul_host]
+        pool = config['consul'].get('pool', {})
+        for agent in agents:
+            if agent not in SESSIONS:
+                create_session(
+                    agent,
+                    pool_size=pool.get('size', pool_size),
+                    keep_alive=pool.get('keep_alive', True),
+                    max_retries=pool.get('max_retries', 3),
+                    backoff_factor=pool.get('backoff_factor', 0.2),
+                    backend='consul-agent'
+                )
+        catalog = CatalogSync(agents, parallelism=len(agents))
+
+    # Background deployment jobs
+    jobs_config = config.get('jobs', {})
+    jobs = JobQueue(
+            consul_host,
+            consul_key_path,
+            workers=jobs_config.get('workers', 2),
+            queue_size=jobs_config.get('queue_size', 100),
+            retention=jobs_config.get('retention', 100)
+        )
+
+
+    def cluster_catalog(cluster):
+        """
+        Consul catalog sync of the cluster, services are registered
+        on Consul agents only from the primary cluster (output: CatalogSync)
+        """
+        return catalog if cluster is primary else None
+
+    def select_clusters():
+        """
+        Names of clusters from comma separated clusters query parameter,
+        None if it's not specified (output: list)
+        """
+        names = request.query.get('clusters')
+        if names is None:
+            return None
+
+        names = [n.strip() for n in names.split(',') if n.strip()]
+        unknown = [n for n in names if n not in clusters]
+        if not names or unknown:
+            abort(422, 'Unknown clusters: {}'.format(', '.join(unknown)))
+
+        return names
+
+    def on_clusters(names, func):
+        """
+        Call function with the primary cluster, or with every one of the
+        named clusters concurrently and report outcome per cluster
+        (output: dict)
+        """
+        if names is None:
+            return func(primary)
+
+        return {'clusters': fan_out([clusters[n] for n in names], func)}
+
+    def deploy_cluster(cluster, namespace, service_name, service_id,
+                       wait=None, update=False):
+        """
+        Create service and deployment objects on Kubernetes cluster
+        and insert retrieved service data into the Consul K/V store,
+        with update only objects that differ from specification deployed
+        on the cluster are changed, with wait (seconds) also wait until
+        deployments are rolled out (output: dict)
+        """
+        started = time.time()
+        k8s_host = cluster['k8s_host']
+        k8s_api_headers = cluster['k8s_api_headers']
+        catalog = cluster_catalog(cluster)
+        spec_key = '{}/specifications/{}/{}'.format(
+                        consul_key_path, namespace, service_name
+                    )
+        deployed_key = '{}/{}'.format(spec_key, cluster['deployed'])
+        svc_key = '{}/deployments/{}'.format(
+                        cluster['key_path'], namespace
+                    )
+
+        payload, pointer = get_spec(
+                consul_host, '{}/{}'.format(spec_key, service_id)
+            )
+        spec_validator(payload)
+        # Before touching the cluster, pointer is written only if the blob
+        # was not cleaned up since then (otherwise it is stored again)
+        blob_index = 0
+        if 'blob' in pointer:
+            blob_index = get_index(consul_host, pointer['blob'])
+
+        deployed = None
+        if update:
+            try:
+                deployed, _ = get_spec(consul_host, deployed_key)
+            except HTTPError as e:
+                if e.status_code != 404:
+                    raise
+                # Nothing deployed yet, all objects will be created
+                deployed = {'objects': {}}
+
+        report = None
+        removed = []
+        if deployed is None:
+            svcs = create_object(
+                        k8s_host, k8s_api_headers=k8s_api_headers,
+                        parallelism=cluster['parallelism'], **payload
+                    )
+        else:
+            svcs, report = update_object(
+                        k8s_host, deployed, k8s_api_headers=k8s_api_headers,
+                        parallelism=cluster['parallelism'], **payload
+                    )
+            removed = (
+                report['services']['deleted'] +
+                report['services']['not found']
+            )
+
+        create_kv(consul_host, dict(
+            ('{}/{}'.format(svc_key, svc['metadata']['name']), svc)
+            for svc in svcs
+        ))
+        if 'blob' in pointer:
+            store_pointers(
+                consul_host, pointer['blob'], spec_blob(payload), blob_index,
+                {deployed_key: pointer}
+            )
+        else:
+            create_kv(consul_host, deployed_key, pointer)
+        if removed:
+            delete_kv(consul_host, [
+                '{}/{}'.format(svc_key, name) for name in removed
+            ])
+
+        result = {'services': svcs}
+        if report is not None:
+            result['objects'] = report
+        if catalog is not None:
+            changes = dict(
+                ((namespace, svc['metadata']['name']), svc) for svc in svcs
+            )
+            changes.update(((namespace, name), None) for name in removed)
+            result['catalog'] = catalog.apply(changes)
+
+        if wait is not None:
+            deployments = wait_deployments(
+                    k8s_host, k8s_api_headers=k8s_api_headers,
+                    timeout=wait, started=started, **payload
+                )
+            result['rollout'] = {
+                'ready': None not in deployments.values(),
+                'seconds': round(time.time() - started, 3),
+                'deployments': deployments
+            }
+
+        return result
+
+    def deploy(namespace, service_name, service_id='latest', wait=None,
+               update=False, clusters=None):
+        """
+        Deploy specification on the primary cluster, or on every one
+        of the named clusters concurrently (output: dict)
+        """
+        return on_clusters(clusters, lambda cluster: deploy_cluster(
+            cluster, namespace, service_name, service_id, wait, update
+        ))
+
+    batch_config = config.get('batch', {})
+
+    def batch(deployments, wait=None, update=False):
+        """
+        Deploy list of services through dependency aware scheduler,
+        service is deployed only after all services it depends on
+        are deployed (and rolled out with wait) (output: dict)
+        """
+        started = time.time()
+
+        def deploy_item(item):
+            result = deploy(
+                    item['namespace'], item['service_name'],
+                    item.get('service_id', 'latest'), wait, update
+                )
+            if wait is not None and not result['rollout']['ready']:
+                abort(504, 'Deployments are not rolled out in {}s: {}'.format(
+                    wait, ', '.join(
+                        name for name, ready in
+                        result['rollout']['deployments'].items()
+                        if ready is None
+                    )
+                ))
+
+            return result
+
+        items = batch_items(deployments)
+        outcomes = run_batch(
+                items, deploy_item,
+                parallelism=batch_config.get('parallelism', 10),
+                namespace_parallelism=batch_config.get('namespace_parallelism')
+            )
+
+        summary = dict((state, 0) for state in
+                       ['succeeded', 'failed', 'skipped'])
+        results = []
+        for item in items:
+            outcome = outcomes[item['key']]
+            summary[outcome['state']] += 1
+            results.append(dict(
+                outcome,
+                namespace=item['namespace'],
+                service_name=item['service_name'],
+                service_id=item.get('service_id', 'latest')
+            ))
+
+        return {
+            'deployments': results,
+            'summary': summary,
+            'seconds': round(time.time() - started, 3)
+        }
+
+    jobs.register('deploy', deploy)
+    jobs.register('batch', batch)
+    jobs.recover()
+
+    # Continuous reconciliation of Kubernetes services into Consul,
+    # every cluster into its own deployments tree
+    reconciler = config['kubernetes'].get('reconciler', {})
+    if reconciler.get('enabled', False):
+        for cluster in clusters.values():
+            SvcReconciler(
+                cluster['k8s_host'],
+                cluster['k8s_api_headers'],
+                consul_host,
+                cluster['key_path'],
+                debounce=reconciler.get('debounce', 1.0),
+                catalog=cluster_catalog(cluster)
+            ).start()
+
+    # Gauges collected on every scrape of /metrics
+    METRICS.gauge(
+        'k8s_deployer_backend_pool_size',
+        'Max number of pooled connections per backend',
+        lambda: [(labels, size) for labels, size, _, _ in pool_stats()]
+    )
+    METRICS.gauge(
+        'k8s_deployer_backend_pool_connections_in_use',
+        'Number of pooled connections currently in use per backend',
+        lambda: [(labels, used) for labels, _, used, _ in pool_stats()]
+    )
+    METRICS.gauge(
+        'k8s_deployer_backend_connections_created_total',
+        'Number of connections opened per backend',
+        lambda: [(labels, total) for labels, _, _, total in pool_stats()],
+        'counter'
+    )
+    for stat, metric_type in [('size', 'gauge'), ('hits', 'counter'),
+                              ('misses', 'counter'),
+                              ('evictions', 'counter')]:
+        METRICS.gauge(
+            'k8s_deployer_cache_{}{}'.format(
+                stat, '_total' if metric_type == 'counter' else ''
+            ),
+            'Specifications cache {}'.format(stat),
+            lambda stat=stat: [
+                ((('prefix', c['prefix']),), c[stat])
+                for c in [cache.stats() for cache in KV_CACHES.values()]
+            ],
+            metric_type
+        )
+    METRICS.gauge(
+        'k8s_deployer_jobs_workers',
+        'Number of background job workers',
+        lambda: [((), jobs.workers)]
+    )
+    METRICS.gauge(
+        'k8s_deployer_jobs_active',
+        'Number of queued and running background jobs',
+        lambda: [((), len(jobs.active))]
+    )
+    for stat in ['calls', 'shared']:
+        METRICS.gauge(
+            'k8s_deployer_backend_reads_{}_total'.format(stat),
+            'Number of backend reads {} per backend'.format(
+                'issued' if stat == 'calls' else
+                'served by a read already in flight'
+            ),
+            lambda stat=stat: [
+                ((('backend', backend),), getattr(flights, stat))
+                for backend, flights in sorted(FLIGHTS.items())
+            ],
+            'counter'
+        )
+    install(metrics_plugin)
 
     @get('/specifications')
     @get('/specifications/<namespace>')
@@ -448,23 +3387,70 @@ def main():
     @get('/specifications/<namespace>/<service_name>/<service_id>')
     def show_spec(namespace=None, service_name=None, service_id=None):
         """
-        Show all available specifications from Consul K/V store
+        Show namespaces, services in the namespace, specification IDs
+        of the service (one level at a time, paginated with limit and
+        after) or specification from Consul K/V store
         """
         spec_key = '{}/specifications'.format(consul_key_path)
 
-        if namespace is None:
-            payload = get_kv(consul_host, spec_key, list_keys=True)
-        elif namespace is not None and service_name is None:
-            spec_key += '/{}'.format(namespace)
-            payload = get_kv(consul_host, spec_key, list_keys=True)
-        elif service_name is not None and service_id is None:
-            spec_key += '/{}/{}'.format(namespace, service_name)
-            payload = get_kv(consul_host, spec_key, list_keys=True)
-        else:
+        if service_id is not None:
             spec_key += '/{}/{}/{}'.format(namespace, service_name, service_id)
-            payload = get_kv(consul_host, spec_key)
 
-        return {'specifications': payload}
+            # Stored bytes are passed through into the response when asked
+            # for, specification is neither decoded nor encoded again
+            if (request.query.get('raw') == 'true' or
+                    SPEC_RAW_MEDIA_TYPE in request.headers.get('Accept', '')):
+                parts = get_raw_spec(consul_host, spec_key)
+                if parts is not None:
+                    parts = [b'{"specifications":'] + parts + [b'}']
+                    response.content_type = SPEC_RAW_MEDIA_TYPE
+                    response.content_length = sum(len(p) for p in parts)
+                    return iter(parts)
+
+            payload, _ = get_spec(consul_host, spec_key)
+
+            return {'specifications': payload}
+
+        limit = request.query.get('limit')
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                abort(422, 'Limit has to be a positive number')
+            if limit <= 0:
+                abort(422, 'Limit has to be a positive number')
+
+        if namespace is not None:
+            spec_key += '/{}'.format(namespace)
+        if service_name is not None:
+            spec_key += '/{}'.format(service_name)
+
+        keys = list_kv(consul_host, spec_key, separator='/')
+        if service_name is not None:
+            # Nested "directories" aren't specifications
+            keys = [k for k in keys if not k.endswith('/')]
+        if not keys:
+            abort(404, 'Nothing found under {}'.format(spec_key))
+
+        # Keys are sorted, listing continues after the last key of
+        # the previous page
+        after = request.query.get('after')
+        start = bisect_right(keys, after) if after else 0
+        end = start + limit if limit is not None else len(keys)
+
+        result = {'specifications': keys[start:end]}
+        if end < len(keys):
+            result['next'] = keys[end - 1]
+
+        return result
+
+
+    @get('/cache')
+    def show_cache():
+        """
+        Show Consul K/V cache statistics
+        """
+        return {'cache': [c.stats() for c in KV_CACHES.values()]}
 
 
     @post('/specifications/<namespace>/<service_name>')
@@ -478,27 +3464,70 @@ def main():
         payload = request.json
         spec_validator(payload)
 
-        service_id = '{:.0f}_{}'.format(time.time() * 10**6, uuid4())
-        payload['id'] = service_id
+        # Content is stored once per digest, revisions and latest
+        # are pointers to it
+        payload['id'] = None
         payload['namespace'] = namespace
         spec_key = '{}/specifications/{}/{}'.format(
                         consul_key_path, namespace, service_name
                     )
+        blob_key = '{}/{}'.format(blob_dir(spec_key), spec_digest(payload))
+        latest_key = spec_key + '/latest'
+
+        # Pointers are read along with their modify indexes at once,
+        # cleanup reuses them
+        keys = list_spec_kv(consul_host, spec_key)
+        entries = get_entries(consul_host, [
+            k for k in keys
+            if k == blob_key or (
+                k.startswith(spec_key + '/') and
+                '/' not in k[len(spec_key) + 1:]
+            )
+        ])
+        latest = entries.get(latest_key, (None, 0))[0] or {}
+        # Same as the latest specification, nothing to store
+        if latest.get('blob') == blob_key:
+            response.status = 200
+            response.add_header(
+                'Location', '{}/{}'.format(spec_key, latest['id'])
+            )
+            return
+
+        service_id = '{:.0f}_{}'.format(time.time() * 10**6, uuid4())
+        service_key = '{}/{}'.format(spec_key, service_id)
+        pointer = {'id': service_id, 'blob': blob_key}
+        written = store_pointers(
+                consul_host, blob_key, spec_blob(payload),
+                entries.get(blob_key, (None, 0))[1],
+                {service_key: pointer, latest_key: pointer}
+            )
+
+        response.add_header('Location', service_key)
 
-        for key in [service_id, 'latest']:
-            create_kv(consul_host, '{}/{}'.format(spec_key, key), payload)
+        # Cleanup, new revision is the newest one
+        entries.update(
+            (k, (pointer, written[k])) for k in [service_key, latest_key]
+        )
+        rotate_specs(
+            consul_host, spec_key, spec_retention, spec_pointers,
+            keys + [service_key, blob_key], entries
+        )
 
-        response.add_header('Location', '{}/{}'.format(spec_key, service_id))
 
-        # Cleanup
-        spec_revs = get_kv(consul_host, spec_key, list_keys=True)
-        for p in ['/latest', '/deployed']:
-            preserve = spec_key + p
-            if preserve in spec_revs:
-                spec_revs.remove(preserve)
+    def deploy_options():
+        """
+        Update and wait (seconds) deployment options from query string
+        (output: tuple)
+        """
+        update = request.query.get('update') == 'true'
+        wait = None
+        if request.query.get('wait') == 'true':
+            try:
+                wait = float(request.query.get('timeout', 300))
+            except ValueError:
+                abort(422, 'Timeout has to be a number of seconds')
 
-        stale_revs = sorted(spec_revs)[:-spec_retention]
-        delete_kv(consul_host, stale_revs)
+        return update, wait
 
 
     @put('/deployments/<namespace>/<service_name>')
@@ -506,30 +3535,146 @@ def main():
     def deploy_spec(namespace, service_name, service_id='latest'):
         """
         Create service and deployment objects on Kubernetes
-        and insert retrieved service data into the Consul K/V store
+        and insert retrieved service data into the Consul K/V store,
+        with async=true deployment is executed as a background job
         """
-        spec_key = '{}/specifications/{}/{}'.format(
-                        consul_key_path, namespace, service_name
-                    )
-        svc_key = '{}/deployments/{}'.format(
-                        consul_key_path, namespace
-                    )
+        update, wait = deploy_options()
+        names = select_clusters()
+
+        if request.query.get('async') == 'true':
+            params = {
+                'namespace': namespace,
+                'service_name': service_name,
+                'service_id': service_id,
+                'wait': wait,
+                'update': update
+            }
+            if names is not None:
+                params['clusters'] = names
+            job = jobs.submit('deploy', params)
+            response.status = 202
+            response.add_header('Location', '/jobs/{}'.format(job['id']))
 
-        payload = get_kv(consul_host, '{}/{}'.format(spec_key, service_id))
-        spec_validator(payload)
+            return {'job': job}
 
-        svcs = create_object(
-                    k8s_host, k8s_api_headers=k8s_api_headers, **payload
-                )
-        for svc in svcs:
-            create_kv(
-                consul_host,
-                '{}/{}'.format(svc_key, svc['metadata']['name']),
-                svc
+        result = deploy(
+                namespace, service_name, service_id, wait, update, names
             )
-        create_kv(consul_host, spec_key + '/deployed', payload)
+        if names is None:
+            results = [result]
+        else:
+            outcomes = result['clusters'].values()
+            if any(o['state'] == 'failed' for o in outcomes):
+                response.status = 502
+            results = [o['result'] for o in outcomes if o['result']]
+        # Objects are created but not rolled out in time
+        if wait is not None and response.status_code != 502 and not all(
+                r['rollout']['ready'] for r in results):
+            response.status = 504
+
+        return result
+
+
+    @post('/deployments/batch')
+    def deploy_batch():
+        """
+        Deploy multiple services with one request, services are deployed
+        concurrently within the limits and in order of their dependencies,
+        with async=true batch is executed as a background job
+        """
+        update, wait = deploy_options()
+
+        payload = request.json
+        if not isinstance(payload, dict):
+            abort(422, 'Bad JSON schema: list of deployments is missing')
+        deployments = payload.get('deployments')
+        # Validate before the job is accepted
+        batch_items(deployments)
+
+        if request.query.get('async') == 'true':
+            job = jobs.submit('batch', {
+                'deployments': deployments,
+                'wait': wait,
+                'update': update
+            })
+            response.status = 202
+            response.add_header('Location', '/jobs/{}'.format(job['id']))
+
+            return {'job': job}
+
+        result = batch(deployments, wait, update)
+        if result['summary']['succeeded'] < len(result['deployments']):
+            response.status = 502
+
+        return result
+
+
+    @get('/metrics')
+    def show_metrics():
+        """
+        Show metrics in Prometheus text format
+        """
+        response.content_type = 'text/plain; version=0.0.4'
+
+        return METRICS.render()
+
+
+    @get('/jobs/<job_id>')
+    def show_job(job_id):
+        """
+        Show state of the background job
+        """
+        return {'job': jobs.get(job_id)}
 
-        return {'services': svcs}
+
+    @put('/registration')
+    @put('/registration/<namespace>')
+    def sync_svcs(namespace=None):
+        """
+        Fetch all NodePort service definitions from Kubernetes namespace
+        (or whole cluster) with one request, optionally filtered by label
+        and field selectors, and populate Consul K/V store only with
+        definitions that have changed, with prune=true also remove
+        definitions of services that no longer exist
+        """
+        label_selector = request.query.get('labelSelector')
+        field_selector = request.query.get('fieldSelector')
+        prune = request.query.get('prune') == 'true'
+
+        if prune and (label_selector or field_selector):
+            abort(422, 'Prune can not be combined with selectors')
+
+        def sync(cluster):
+            svcs = list_svcs(
+                    cluster['k8s_host'],
+                    k8s_api_headers=cluster['k8s_api_headers'],
+                    namespace=namespace,
+                    labelSelector=label_selector,
+                    fieldSelector=field_selector
+                )
+
+            result = {
+                'services': sync_svcs_kv(
+                    consul_host, cluster['key_path'], svcs,
+                    namespace=namespace, prune=prune
+                )
+            }
+            catalog = cluster_catalog(cluster)
+            if catalog is not None:
+                result['catalog'] = catalog.apply(dict(
+                    ((svc['metadata']['namespace'], svc['metadata']['name']),
+                     svc)
+                    for svc in svcs
+                ), prune=prune, namespace=namespace)
+
+            return result
+
+        result = on_clusters(select_clusters(), sync)
+        if any(o['state'] == 'failed'
+               for o in result.get('clusters', {}).values()):
+            response.status = 502
+
+        return result
 
 
     @put('/registration/<namespace>/<service_name>')
@@ -538,69 +3683,137 @@ def main():
         Fetch service definition for specified service from Kubernetes
         and populate Consul K/V store with received data
         """
-        svc_key = '{}/deployments/{}/{}'.format(
-                        consul_key_path, namespace, service_name
-                    )
+        def register(cluster):
+            svc_key = '{}/deployments/{}/{}'.format(
+                            cluster['key_path'], namespace, service_name
+                        )
+
+            svc = fetch_svc(
+                    cluster['k8s_host'],
+                    k8s_api_headers=cluster['k8s_api_headers'],
+                    namespace=namespace,
+                    service_name=service_name
+                )
+            create_kv(consul_host, svc_key, svc)
+            catalog = cluster_catalog(cluster)
+            if catalog is not None:
+                catalog.apply({(namespace, service_name): svc})
 
-        svc = fetch_svc(
-                k8s_host,
-                k8s_api_headers=k8s_api_headers,
-                namespace=namespace,
-                service_name=service_name
-            )
-        create_kv(consul_host, svc_key, svc)
+            return svc
+
+        result = on_clusters(select_clusters(), register)
+        if any(o['state'] == 'failed'
+               for o in result.get('clusters', {}).values()):
+            response.status = 502
 
-        return svc
+        return result
 
 
     @delete('/deployments/<namespace>/<service_name>')
     def delete_svc(namespace, service_name):
         """
         Delete all related Kubernetes objects for specified service
-        and remove Consul keys from specifications and deployments tree
+        and remove Consul keys from specifications and deployments tree,
+        outcome is reported per object (and per cluster)
         """
-        response.status = 204
 
         spec_key = '{}/specifications/{}/{}'.format(
                         consul_key_path, namespace, service_name
                     )
-        svc_key = '{}/deployments/{}'.format(
-                        consul_key_path, namespace
-                    )
 
-        payload = get_kv(consul_host, '{}/{}'.format(spec_key, 'deployed'))
-        spec_validator(payload)
+        def undeploy(cluster):
+            k8s_host = cluster['k8s_host']
+            k8s_api_headers = cluster['k8s_api_headers']
+            deployed_key = '{}/{}'.format(spec_key, cluster['deployed'])
+            svc_key = '{}/deployments/{}'.format(
+                            cluster['key_path'], namespace
+                        )
+
+            payload, _ = get_spec(consul_host, deployed_key)
+            spec_validator(payload)
+
+            # Consul
+            # Delete specs
+            specs = payload['objects']['services']['specification']
+            if specs['kind'] == 'List':
+                specs = specs['items']
+            else:
+                specs = [specs]
+
+            delete_kv(consul_host, [deployed_key] + [
+                '{}/{}'.format(svc_key, spec['metadata']['name'])
+                for spec in specs
+            ])
+            catalog = cluster_catalog(cluster)
+            if catalog is not None:
+                catalog.apply(dict(
+                    ((namespace, spec['metadata']['name']), None)
+                    for spec in specs
+                ))
+
+            # Kubernetes
+            # Terminate all running pods (scale down to 0)
+            scaled = scale_down(
+                        k8s_host, k8s_api_headers=k8s_api_headers,
+                        parallelism=cluster['parallelism'], **payload
+                    )
+            # Delete all related objects
+            report = delete_object(
+                        k8s_host, k8s_api_headers=k8s_api_headers,
+                        parallelism=cluster['parallelism'], **payload
+                    )
 
-        # Consul
-        # Delete specs
-        delete_kv(consul_host, spec_key + '/deployed')
-        specs = payload['objects']['services']['specification']
-        if specs['kind'] == 'List':
-            for spec in specs['items']:
-                delete_kv(
-                    consul_host,
-                    '{}/{}'.format(svc_key, spec['metadata']['name'])
-                )
+            return {'objects': dict(
+                (obj, dict(
+                    (name, dict(
+                        [('delete', result)] +
+                        ([('scale_down', scaled[name])]
+                         if obj == 'deployments' and name in scaled else [])
+                    ))
+                    for name, result in results.items()
+                ))
+                for obj, results in report.items()
+            )}
+
+        names = select_clusters()
+        result = on_clusters(names, undeploy)
+
+        # Content blob could be referenced only by deployed specification
+        rotate_specs(consul_host, spec_key, spec_retention, spec_pointers)
+
+        if names is None:
+            results = [result]
         else:
-            delete_kv(
-                consul_host,
-                '{}/{}'.format(svc_key, specs['metadata']['name'])
-            )
-
-        # Kubernetes
-        # Terminate all running pods (scale down to 0)
-        scale_down(k8s_host, k8s_api_headers=k8s_api_headers, **payload)
-        # Delete all related objects
-        delete_object(k8s_host, k8s_api_headers=k8s_api_headers, **payload)
-
-
-    run(
-        host=bind_addr,
-        port=bind_port,
-        server='paste',
-        use_threadpool=True,
-        threadpool_workers=workers
-    )
+            outcomes = result['clusters'].values()
+            if any(o['state'] == 'failed' for o in outcomes):
+                response.status = 502
+            results = [o['result'] for o in outcomes if o['result']]
+        # Leftovers are possible only if deletion itself has failed
+        if any(
+            outcome['delete'].startswith('failed')
+            for r in results for objs in r['objects'].values()
+            for outcome in objs.values()
+        ):
+            response.status = 502
+
+        return result
+
+
+    if args.server == 'gevent':
+        run(
+            host=bind_addr,
+            port=bind_port,
+            server='gevent',
+            spawn=args.connections
+        )
+    else:
+        run(
+            host=bind_addr,
+            port=bind_port,
+            server='paste',
+            use_threadpool=True,
+            threadpool_workers=workers
+        )
 
 
 if __name__ == '__main__':